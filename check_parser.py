@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import contextlib
+import io
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+
+from logparse_common import open_log
+
+'''
+Проверка разбора строк logparse_re.py: на каждой строке корпуса
+(по умолчанию testdata/parser_corpus.log, строки с # - комментарии)
+результат tokenize_line() и разбора только полей --group-by должен совпадать
+с parse_line(), то есть с регулярным выражением. Код выхода 1 при расхождении.
+'''
+
+HERE = Path(__file__).resolve().parent
+
+parser = ArgumentParser()
+parser.add_argument('--file', action='append', default=None)
+args = parser.parse_args()
+
+# logparse_re разбирает аргументы при импорте
+sys.argv = [sys.argv[0], '--file', '-']
+import logparse_re  # noqa: E402
+
+
+def gen_lines(files):
+    """Lines of the files prepared as logparse_re.gen_data() does"""
+
+    for file in files:
+        with open_log(file, 'r') as f:
+            for line in f:
+                line = line.strip(' \n\r')
+                if line and not line.startswith('#'):
+                    yield line
+
+
+def check(line, project):
+    """Descriptions of the parsers disagreeing with parse_line()"""
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        expected = logparse_re.parse_line(line)
+        results = {'tokenize_line': logparse_re.tokenize_line(line),
+                   'project_line': project(line)}
+
+    return [f'{name}: {result!r}, parse_line: {expected!r}'
+            for name, result in results.items() if result != expected]
+
+
+def main():
+    files = args.file or [HERE / 'testdata' / 'parser_corpus.log']
+    project = logparse_re.project_line(logparse_re.FIELDS)
+
+    total, failed = 0, 0
+    for line in gen_lines(files):
+        total += 1
+        errors = check(line, project)
+        if errors:
+            failed += 1
+            print(repr(line))
+            for error in errors:
+                print('   ', error)
+
+    print(f'{total} lines, {failed} mismatches')
+    if failed:
+        exit(1)
+
+
+if __name__ == '__main__':
+
+    main()
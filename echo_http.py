@@ -1,265 +1,1441 @@
+import asyncio
+import atexit
+import cProfile
+import functools
+import hashlib
 import logging
+import math
+import os
+import pstats
+import queue
 import re
 import selectors
+import signal
 import socket
+import sys
+import time
+import tracemalloc
 from argparse import ArgumentParser
-from collections import namedtuple
+from collections import Counter, OrderedDict, deque
 from http import HTTPStatus
-from urllib.parse import parse_qs, urlencode, urlparse
+from itertools import islice
+from logging.handlers import QueueHandler, QueueListener
+from pathlib import Path
+from urllib.parse import parse_qs, unquote_to_bytes
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 parser = ArgumentParser()
 parser.add_argument('--host', default='0.0.0.0')
 parser.add_argument('--port', type=int, default=9000)
+parser.add_argument('--workers', type=int, default=0)
+parser.add_argument('--engine', choices=('selectors', 'asyncio'),
+                    default='selectors')
+parser.add_argument('--idle-timeout', type=float, default=60)
+parser.add_argument('--header-timeout', type=float, default=10)
+parser.add_argument('--max-connections', type=int, default=0)
+parser.add_argument('--log-level', default='INFO',
+                    choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'))
+parser.add_argument('--cache-size', type=int, default=0)
+parser.add_argument('--cache-bytes', type=int, default=64 * 1024 * 1024)
+parser.add_argument('--profile', action='store_true')
+parser.add_argument('--profile-every', type=int, default=1)
+parser.add_argument('--profile-dump', type=int, default=0)
+parser.add_argument('--profile-dir', default='./')
 args = parser.parse_args()
 
-Header = namedtuple('Header', ('name', 'value'))
-
 HOST, PORT = args.host, args.port
-BUFF_SIZE = 4096
+WORKERS = args.workers
+ENGINE = args.engine
+IDLE_TIMEOUT = args.idle_timeout
+HEADER_TIMEOUT = args.header_timeout
+MAX_CONNECTIONS = args.max_connections
+LOG_LEVEL = args.log_level
+CACHE_SIZE = args.cache_size
+CACHE_BYTES = args.cache_bytes
+PROFILE = args.profile
+PROFILE_EVERY = max(args.profile_every, 1)
+PROFILE_DUMP = args.profile_dump
+PROFILE_DIR = args.profile_dir
+# timer wheel resolution, seconds
+TICK = 1.0
+# a worker exiting sooner than this after start failed at startup, its
+# restart is delayed, the delay doubles on every failure in a row up to
+# the maximum, the supervisor gives up after that many failures in a row
+MIN_UPTIME = 5.0
+RESTART_DELAY = 0.1
+MAX_RESTART_DELAY = 30.0
+MAX_START_FAILURES = 5
+BUFF_SIZE = 65536
+MAX_HEAD_SIZE = 65536
+MAX_BODY_SIZE = 16 * 1024 * 1024
+# form bodies are parsed as they arrive and may be larger
+MAX_UPLOAD_SIZE = 1024 * 1024 * 1024
+MAX_FIELD_SIZE = 65536
+# stop reading from a client while this much output is waiting for it
+HIGH_WATER = 1024 * 1024
+LOW_WATER = 256 * 1024
+
+HEAD_END = b'\r\n\r\n'
+METHODS = (b'GET', b'POST')
+STATS_PATH = b'/__stats'
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+
+# pre-encoded pieces of the response head
+STATUSES = {status.value: status for status in HTTPStatus}
+STATUS_TEXT = {status: f'{status.value} {status.phrase}'.encode()
+               for status in HTTPStatus}
+STATUS_LINES = {status: b' ' + text + b'\r\n'
+                for status, text in STATUS_TEXT.items()}
+RESPONSE_HEADERS = {
+    True: b'Connection: keep-alive\r\nContent-Type: text/html\r\n',
+    False: b'Connection: close\r\nContent-Type: text/html\r\n',
+}
+STATS_HEADERS = {
+    True: b'Connection: keep-alive\r\nContent-Type: text/plain; version=0.0.4\r\n',
+    False: b'Connection: close\r\nContent-Type: text/plain; version=0.0.4\r\n',
+}
+CONTENT_LENGTH = re.compile(
+    rb'^content-length:[ \t]*(\S*)[ \t]*\r?$', re.IGNORECASE | re.MULTILINE)
+CONTENT_TYPE = re.compile(
+    rb'^content-type:[ \t]*(.*?)[ \t]*\r?$', re.IGNORECASE | re.MULTILINE)
+DISPOSITION_PARAM = re.compile(
+    rb';\s*(name|filename)="([^"]*)"', re.IGNORECASE)
 
 selector = selectors.DefaultSelector()
 
+connections = {}
+
+listener = None
+accepting = True
+
 logger = None
+access_logger = None
+log_listener = None
+
+
+class LogQueueHandler(QueueHandler):
+    '''Queue log records as they are, so that even message
+    formatting happens in the listener thread'''
+
+    def prepare(self, record):
+        return record
 
 
 def init_logger(name):
+    '''Route log records through a queue to the listener thread
+    which writes them to stderr, off the event loop thread'''
+
     LOG_FORMAT = '{asctime} [{levelname}] [{name}] [{funcName}] > {message}'
-    logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT, style='{', )
-    global logger
+    global logger, access_logger, log_listener
+
+    if log_listener:
+        log_listener.stop()
+
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT, style='{'))
+
+    root = logging.getLogger()
+    root.handlers[:] = [LogQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+
+    log_listener = QueueListener(log_queue, handler)
+    log_listener.start()
+
     logger = logging.getLogger(name)
+    access_logger = logging.getLogger(f'{name}.access')
 
 
-def find_http_status(code):
-    """Find HTTP status by its code"""
+def stop_logger():
+    '''Write out queued log records'''
 
-    for status in HTTPStatus:
-        if status.value == code:
-            return status
+    if log_listener:
+        log_listener.stop()
 
 
-def server(host, port):
-    """Run TCP server"""
+class TimerWheel:
+    '''Hashed timing wheel of connection deadlines.
+
+    A connection is filed into the slot of its deadline tick. Moving the
+    deadline forward only updates the connection, it is re-filed when its
+    old slot comes due; a deadline moved earlier than the filed tick is
+    re-filed at once. Both refreshing a deadline and checking for expired
+    ones cost O(1) per tick regardless of the number of sockets'''
+
+    def __init__(self, size, resolution=TICK):
+        self.slots = [set() for _ in range(size)]
+        self.resolution = resolution
+        self.tick = int(time.monotonic() / resolution)
+
+    def add(self, conn):
+        tick = max(int(conn.deadline / self.resolution), self.tick)
+        conn.timer_tick = tick
+        conn.timer_slot = self.slots[tick % len(self.slots)]
+        conn.timer_slot.add(conn)
+
+    def update(self, conn):
+        '''File the connection after its deadline has changed'''
+
+        if conn.timer_slot is None:
+            self.add(conn)
+        elif int(conn.deadline / self.resolution) < conn.timer_tick:
+            self.remove(conn)
+            self.add(conn)
+
+    def remove(self, conn):
+        if conn.timer_slot is not None:
+            conn.timer_slot.discard(conn)
+            conn.timer_slot = None
+
+    def expire(self, now):
+        '''Return connections whose deadlines have passed'''
+
+        expired = []
+        now_tick = int(now / self.resolution)
+        # after a long stall every slot has to be visited only once
+        self.tick = max(self.tick, now_tick - len(self.slots) + 1)
+
+        while self.tick <= now_tick:
+            slot = self.slots[self.tick % len(self.slots)]
+            self.tick += 1
+            for conn in list(slot):
+                slot.discard(conn)
+                conn.timer_slot = None
+                if conn.deadline <= now:
+                    expired.append(conn)
+                elif conn.deadline < math.inf:
+                    self.add(conn)
+
+        return expired
+
+
+timers = TimerWheel(int(max(IDLE_TIMEOUT, HEADER_TIMEOUT) / TICK) + 2)
+
+
+class Histogram:
+    '''Latency histogram with fixed power-of-two microsecond buckets,
+    recording a value is one bit_length() call and an increment'''
+
+    BUCKETS = 24
+
+    def __init__(self):
+        self.counts = [0] * (self.BUCKETS + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def record(self, seconds):
+        self.counts[min(int(seconds * 1e6).bit_length(), self.BUCKETS)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def exposition(self, name):
+        '''Cumulative buckets in Prometheus text format'''
+
+        lines = [f'# TYPE {name} histogram']
+        total = 0
+        for i, count in enumerate(self.counts[:-1]):
+            total += count
+            lines.append(f'{name}_bucket{{le="{2 ** i / 1e6:g}"}} {total}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum {self.sum:.6f}')
+        lines.append(f'{name}_count {self.count}')
+
+        return lines
+
+
+class Stats:
+    '''Runtime counters of the server process'''
+
+    def __init__(self):
+        self.accepted = 0
+        self.closed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.requests = Counter()
+        self.parse = Histogram()
+        self.generate = Histogram()
+        # whole time of requests answered from the response cache
+        self.cache_hit = Histogram()
+
+    def exposition(self):
+        '''All metrics in Prometheus text format'''
+
+        lines = [
+            '# TYPE echo_connections_open gauge',
+            f'echo_connections_open {len(connections)}',
+            '# TYPE echo_connections_accepted_total counter',
+            f'echo_connections_accepted_total {self.accepted}',
+            '# TYPE echo_connections_closed_total counter',
+            f'echo_connections_closed_total {self.closed}',
+            '# TYPE echo_received_bytes_total counter',
+            f'echo_received_bytes_total {self.bytes_in}',
+            '# TYPE echo_sent_bytes_total counter',
+            f'echo_sent_bytes_total {self.bytes_out}',
+            '# TYPE echo_requests_total counter',
+        ]
+        lines.extend(
+            f'echo_requests_total{{method="{method.decode("latin-1")}",status="{status}"}} {count}'
+            for (method, status), count in sorted(self.requests.items()))
+        lines.extend(self.parse.exposition('echo_parse_seconds'))
+        lines.extend(self.generate.exposition('echo_generate_seconds'))
+
+        if cache:
+            lines.extend(self.cache_hit.exposition('echo_cache_hit_seconds'))
+            lines.extend([
+                '# TYPE echo_cache_hits_total counter',
+                f'echo_cache_hits_total {cache.hits}',
+                '# TYPE echo_cache_misses_total counter',
+                f'echo_cache_misses_total {cache.misses}',
+                '# TYPE echo_cache_entries gauge',
+                f'echo_cache_entries {len(cache.entries)}',
+                '# TYPE echo_cache_bytes gauge',
+                f'echo_cache_bytes {cache.size}',
+            ])
+
+        return ('\n'.join(lines) + '\n').encode()
+
+
+stats = Stats()
+
+
+class ResponseCache:
+    '''LRU cache of rendered responses bounded by the number of entries
+    and their total size'''
+
+    def __init__(self, max_entries, max_bytes):
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+
+        return entry[0]
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+
+        self.entries[key] = (value, size)
+        self.size += size
+
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= evicted
+
+
+cache = ResponseCache(CACHE_SIZE, CACHE_BYTES) if CACHE_SIZE > 0 else None
+
+
+class Profiler:
+    '''cProfile of every Nth call of the wrapped request handling entry
+    points plus tracemalloc snapshots. Reports are written on SIGUSR1 or
+    every N requests, each covers the time since the previous one'''
+
+    def __init__(self, every, dump_every, directory):
+        self.profile = cProfile.Profile()
+        self.every = every
+        self.dump_every = dump_every
+        self.directory = Path(directory)
+        self.calls = 0
+        self.requests = 0
+        self.active = False
+        self.dump_requested = False
+        self.dumps = 0
+        self.snapshot = None
+        tracemalloc.start()
+
+    def wrap(self, func):
+        '''Profile sampled calls of func'''
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            self.calls += 1
+            if self.active or self.calls % self.every:
+                return func(*args, **kwargs)
+            self.active = True
+            try:
+                return self.profile.runcall(func, *args, **kwargs)
+            finally:
+                self.active = False
+
+        return wrapper
+
+    def count_request(self):
+        self.requests += 1
+        if self.dump_every and self.requests % self.dump_every == 0:
+            self.dump_requested = True
+
+    def request_dump(self, *args):
+        '''SIGUSR1 handler, the dump itself is done by the event loop'''
+
+        self.dump_requested = True
+
+    def dump(self):
+        '''Write pstats file and text report with the slowest calls
+        and the top allocations, start next profiling period'''
+
+        self.dump_requested = False
+        self.dumps += 1
+        base = self.directory / f'echo-profile-{os.getpid()}-{self.dumps}'
+
+        self.profile.dump_stats(f'{base}.pstats')
+        self.profile.clear()
+
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__),
+             tracemalloc.Filter(False, pstats.__file__)))
+
+        with open(f'{base}.txt', 'w') as f:
+            f.write(f'Requests: {self.requests}, profiled calls: '
+                    f'{self.calls // self.every} of {self.calls}\n\n')
+            try:
+                stats = pstats.Stats(f'{base}.pstats', stream=f)
+                stats.sort_stats('cumulative').print_stats(40)
+            except TypeError:
+                f.write('No calls profiled\n\n')
+
+            f.write('Top allocations:\n')
+            for stat in snapshot.statistics('lineno')[:20]:
+                f.write(f'{stat}\n')
+
+            if self.snapshot:
+                f.write('\nAllocation changes since previous report:\n')
+                for stat in snapshot.compare_to(self.snapshot, 'lineno')[:20]:
+                    f.write(f'{stat}\n')
+
+        self.snapshot = snapshot
+        logger.info('Profile written to %s.pstats and %s.txt', base, base)
+
+
+profiler = None
+
+
+def init_profiler():
+    '''Wrap request handling entry points of both engines'''
+
+    global profiler, reply
+    profiler = Profiler(PROFILE_EVERY, PROFILE_DUMP, PROFILE_DIR)
+    reply = profiler.wrap(reply)
+    EchoProtocol.data_received = profiler.wrap(EchoProtocol.data_received)
+    signal.signal(signal.SIGUSR1, profiler.request_dump)
+
+
+def check_profiler():
+    '''Write profile report if requested, outside of profiled code'''
+
+    if profiler and profiler.dump_requested:
+        profiler.dump()
+
+
+class FormParser:
+    '''Incremental parser of x-www-form-urlencoded and multipart/form-data
+    bodies. Chunks are consumed as they arrive, at most one field value and
+    a boundary worth of bytes are kept in memory. Values longer than
+    MAX_FIELD_SIZE are dropped, file parts are skipped and only their
+    file names are kept as field values'''
+
+    def __init__(self, content_type: bytes):
+        self.fields = {}
+        self.tail = bytearray()
+        self.skipping = False
+        self.mode = None
+        # bytes of the tail already searched for the end of a line or head
+        self.scanned = 0
+
+        mime, _, params = content_type.partition(b';')
+        mime = mime.strip().lower()
+
+        if mime == b'application/x-www-form-urlencoded':
+            self.mode = 'urlencoded'
+
+        elif mime == b'multipart/form-data':
+            for param in params.split(b';'):
+                name, _, value = param.strip().partition(b'=')
+                if name.lower() == b'boundary' and value.strip(b'"'):
+                    # leading CRLF lets the first boundary match as any other
+                    self.delimiter = b'\r\n--' + value.strip(b'"')
+                    self.tail += b'\r\n'
+                    self.state = 'preamble'
+                    self.mode = 'multipart'
+
+    def feed(self, chunk):
+        '''Consume next chunk of the body'''
+
+        self.tail += chunk
+
+        if self.mode == 'urlencoded':
+            self.feed_urlencoded()
+        elif self.mode == 'multipart':
+            self.feed_multipart()
+
+    def close(self):
+        '''Finish parsing, return fields as parse_qs() does'''
+
+        if self.mode == 'urlencoded' and not self.skipping:
+            self.add_pair(self.tail)
+        self.tail.clear()
+
+        return self.fields
+
+    def add(self, name, value):
+        self.fields.setdefault(name, []).append(value)
+
+    def add_pair(self, pair):
+        name, sep, value = bytes(pair).partition(b'=')
+        if sep and value:
+            self.add(unquote_to_bytes(name.replace(b'+', b' ')).decode(errors='replace'),
+                     unquote_to_bytes(value.replace(b'+', b' ')).decode(errors='replace'))
+
+    def feed_urlencoded(self):
+        end = self.tail.rfind(b'&')
+
+        if end < 0:
+            if len(self.tail) > MAX_FIELD_SIZE:
+                self.tail.clear()
+                self.skipping = True
+            return
+
+        pairs = self.tail[:end].split(b'&')
+        if self.skipping:
+            # the rest of the oversized field
+            pairs.pop(0)
+            self.skipping = False
+        for pair in pairs:
+            self.add_pair(pair)
+        del self.tail[:end + 1]
+
+    def feed_multipart(self):
+        while True:
+            if self.state == 'preamble' or self.state == 'data':
+                end = self.tail.find(self.delimiter)
+
+                if end < 0:
+                    # keep the bytes that may be the beginning of a delimiter
+                    end = max(len(self.tail) - len(self.delimiter) + 1, 0)
+                    if self.state == 'data':
+                        self.add_data(end)
+                    del self.tail[:end]
+                    return
+
+                if self.state == 'data':
+                    self.add_data(end)
+                    self.finish_part()
+                del self.tail[:end + len(self.delimiter)]
+                self.scanned = 0
+                self.state = 'boundary'
+
+            elif self.state == 'boundary':
+                if len(self.tail) < 2:
+                    return
+                if self.tail.startswith(b'--'):
+                    self.state = 'end'
+                    continue
+                end = self.tail.find(b'\r\n', self.scanned)
+                if end < 0:
+                    if len(self.tail) > MAX_HEAD_SIZE:
+                        self.state = 'end'
+                        continue
+                    self.scanned = len(self.tail) - 1
+                    return
+                del self.tail[:end + 2]
+                self.scanned = 0
+                self.state = 'headers'
+
+            elif self.state == 'headers':
+                end = self.tail.find(HEAD_END, self.scanned)
+                if end < 0:
+                    if len(self.tail) > MAX_HEAD_SIZE:
+                        self.state = 'end'
+                        continue
+                    self.scanned = max(len(self.tail) - len(HEAD_END) + 1, 0)
+                    return
+
+                self.name = self.filename = None
+                for line in self.tail[:end].split(b'\r\n'):
+                    if line.lower().startswith(b'content-disposition:'):
+                        for key, value in DISPOSITION_PARAM.findall(line):
+                            if key.lower() == b'name':
+                                self.name = value.decode(errors='replace')
+                            else:
+                                self.filename = value.decode(errors='replace')
+                self.value = bytearray()
+                self.size = 0
+                del self.tail[:end + len(HEAD_END)]
+                self.state = 'data'
+
+            else:
+                self.tail.clear()
+                return
+
+    def add_data(self, end):
+        self.size += end
+        if self.filename is None and self.size <= MAX_FIELD_SIZE:
+            self.value += self.tail[:end]
+
+    def finish_part(self):
+        if not self.name:
+            return
+        if self.filename is not None:
+            self.add(self.name, self.filename)
+        elif self.size <= MAX_FIELD_SIZE and self.value:
+            self.add(self.name, self.value.decode(errors='replace'))
+        self.value = None
+
+
+class Connection:
+    '''Client connection state: read buffer and resumable request parser'''
+
+    def __init__(self, sock: socket.socket, addr, transport=None):
+        self.sock = sock
+        self.addr = addr
+        self.transport = transport
+        self.deadline = math.inf
+        self.timer_slot = None
+        self.timer_tick = None
+        self.buffer = bytearray()
+        self.head_size = None
+        self.body_size = 0
+        self.form = None
+        self.broken = False
+        self.outbox = deque()
+        self.pending = 0
+        self.paused = False
+        self.closing = False
+        # the client has shut down its side, no more requests will come
+        self.eof = False
+        self.events = selectors.EVENT_READ
+
+    def feed(self, data):
+        '''Append received bytes to the read buffer'''
+
+        self.buffer += data
+
+    def next_request(self):
+        '''Cut the next complete request (head + Content-Length bytes
+        of body) from the buffer, return None if more data is needed.
+        Form bodies are fed to FormParser as they arrive instead of
+        being buffered, the request is returned with the parsed fields'''
+
+        if self.broken:
+            return None
+
+        if self.head_size is None:
+            end = self.buffer.find(HEAD_END)
+
+            if end < 0:
+                # fail fast on garbage instead of waiting for the head end
+                line_end = self.buffer.find(b'\n')
+                if (len(self.buffer) > MAX_HEAD_SIZE or
+                        line_end >= 0 and
+                        not split_startline(self.buffer[:line_end])):
+                    return self.abort(self.buffer[:MAX_HEAD_SIZE])
+                return None
+
+            if end > MAX_HEAD_SIZE:
+                return self.abort(self.buffer[:MAX_HEAD_SIZE])
+
+            self.head_size = end + len(HEAD_END)
+            self.body_size = 0
+            self.form = None
+
+            match = CONTENT_LENGTH.search(self.buffer, 0, end)
+            if match:
+                try:
+                    self.body_size = int(match.group(1))
+                    assert 0 <= self.body_size
+                except (ValueError, AssertionError):
+                    # let parse_request() reject the header
+                    return self.abort(self.buffer[:self.head_size])
+
+            match = CONTENT_TYPE.search(self.buffer, 0, end)
+            if self.body_size and match and self.buffer.startswith(b'POST '):
+                form = FormParser(match.group(1))
+                if form.mode:
+                    self.form = form
+
+            limit = MAX_BODY_SIZE if self.form is None else MAX_UPLOAD_SIZE
+            if self.body_size > limit:
+                self.form = None
+                return self.abort(self.buffer[:self.head_size])
+
+        if self.form is not None:
+            # body_size counts the bytes yet to come
+            with memoryview(self.buffer) as view:
+                chunk = view[self.head_size:self.head_size + self.body_size]
+                self.form.feed(chunk)
+                size = len(chunk)
+                chunk.release()
+            del self.buffer[self.head_size:self.head_size + size]
+            self.body_size -= size
+            size = self.head_size
+        else:
+            size = self.head_size + self.body_size
+
+        if self.body_size and self.form is not None or len(self.buffer) < size:
+            return None
+
+        request = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.head_size = None
+
+        form, self.form = self.form, None
+
+        return request, form and form.close()
+
+    def queue(self, buffers):
+        '''Put response buffers into the outbound queue'''
+
+        self.outbox.extend(buffers)
+        self.pending += sum(map(len, buffers))
+
+    def abort(self, request):
+        '''Stop parsing the stream, return what is left for error reply'''
+
+        self.broken = True
+        self.buffer.clear()
+
+        return bytes(request), None
+
+
+def listen_socket(host, port):
+    """Create non-blocking listening TCP socket"""
 
     server_socket = socket.socket(
         socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.setsockopt(
-        socket.SOL_SOCKET, socket.SO_REUSEADDR, socket.SO_REUSEPORT)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     server_socket.setblocking(False)
     server_socket.bind((host, port))
     server_socket.listen()
-    logger.debug('Started listening at %s:%s', *server_socket.getsockname())
+    logger.info('Started listening at %s:%s', *server_socket.getsockname())
+
+    return server_socket
+
+
+def server(host, port):
+    """Run TCP server"""
+
+    global listener
+    listener = listen_socket(host, port)
 
-    selector.register(fileobj=server_socket,
+    selector.register(fileobj=listener,
                       events=selectors.EVENT_READ, data=accept)
 
 
+def set_deadline(conn: Connection, timeout):
+    """Expire the connection after timeout seconds, 0 means never"""
+
+    if not timeout:
+        conn.deadline = math.inf
+        return
+
+    conn.deadline = time.monotonic() + timeout
+    timers.update(conn)
+
+
+def arm_timeout(conn: Connection, new_head):
+    """Choose the timeout by what the connection is waiting for:
+    the rest of a request head, more body bytes or the next request"""
+
+    if conn.buffer and conn.head_size is None:
+        if new_head:
+            set_deadline(conn, HEADER_TIMEOUT)
+    else:
+        set_deadline(conn, IDLE_TIMEOUT)
+
+
+def expire_connections(close_connection):
+    """Close connections whose deadlines have passed"""
+
+    for conn in timers.expire(time.monotonic()):
+        logger.debug("Connection from %s:%s timed out", *conn.addr)
+        close_connection(conn)
+
+
 def accept(sock: socket.socket, mask):
     """Accept the client connection,
     register the socket for events polling"""
 
-    client_socket, addrinfo = sock.accept()
+    try:
+        client_socket, addrinfo = sock.accept()
+    except BlockingIOError:
+        return
+
     client_socket.setblocking(False)
     logger.debug('Accepted connection from %s:%s', *addrinfo)
-    logger.debug('Registering client socket %s:%s for READ events', *addrinfo)
+    conn = connections[client_socket] = Connection(client_socket, addrinfo)
+    stats.accepted += 1
     selector.register(fileobj=client_socket,
-                      events=selectors.EVENT_READ, data=reply)
+                      events=selectors.EVENT_READ, data=handle)
+    set_deadline(conn, HEADER_TIMEOUT)
+
+    if MAX_CONNECTIONS and len(connections) >= MAX_CONNECTIONS:
+        # new clients wait in the listen backlog until a slot is free
+        global accepting
+        logger.debug('Connection limit %s reached, pausing accept',
+                     MAX_CONNECTIONS)
+        selector.unregister(sock)
+        accepting = False
 
 
 def close(sock: socket.socket):
-    logger.debug('Unregistering client socket %s:%s', *sock.getpeername())
+    conn = connections.pop(sock)
+    timers.remove(conn)
+    stats.closed += 1
     selector.unregister(sock)
-    logger.debug("Closing connection from %s:%s", *sock.getpeername())
+    logger.debug("Closing connection from %s:%s", *conn.addr)
     sock.close()
 
+    global accepting
+    if not accepting and len(connections) < MAX_CONNECTIONS:
+        logger.debug('Resuming accept')
+        selector.register(fileobj=listener,
+                          events=selectors.EVENT_READ, data=accept)
+        accepting = True
 
-def reply(sock: socket.socket, mask):
-    """Send reply to client"""
 
-    client_addr = sock.getpeername()
+def handle(sock: socket.socket, mask):
+    """Dispatch client socket events"""
+
+    if mask & selectors.EVENT_WRITE:
+        flush(sock)
+
+    if mask & selectors.EVENT_READ and sock in connections:
+        reply(sock, mask)
 
-    request = sock.recv(BUFF_SIZE)
 
-    if request:
-        logger.debug("Got request from %s:%s", *client_addr)
+def update_events(conn: Connection):
+    """Poll for READ unless reads are paused or the connection
+    is closing or at EOF, and for WRITE while output is pending"""
 
-        response = generate_response(request, client_addr)
+    events = 0
+    if not conn.paused and not conn.closing and not conn.eof:
+        events |= selectors.EVENT_READ
+    if conn.outbox:
+        events |= selectors.EVENT_WRITE
 
-        logger.debug("Sending response to %s:%s", *client_addr)
-        sock.sendall(response)
+    if events != conn.events:
+        selector.modify(conn.sock, events, data=handle)
+        conn.events = events
 
-        if HTTPStatus.BAD_REQUEST.phrase in response.decode():
-            logger.debug("Got %s from %s:%s",
-                         HTTPStatus.BAD_REQUEST.phrase, *client_addr)
+
+def reply(sock: socket.socket, mask):
+    """Read client data, queue replies to all complete
+    (possibly pipelined) requests in the buffer"""
+
+    conn = connections[sock]
+
+    try:
+        data = sock.recv(BUFF_SIZE)
+    except BlockingIOError:
+        return
+    except ConnectionError:
+        logger.debug("Client %s:%s has disconnected", *conn.addr)
+        close(sock)
+        return
+
+    if not data:
+        # a half-closed client still gets replies to the requests
+        # it has sent, the connection is closed once they are flushed
+        logger.debug("Client %s:%s has finished sending", *conn.addr)
+        conn.eof = True
+        process(conn)
+        flush(sock)
+        return
+
+    stats.bytes_in += len(data)
+    new_head = not conn.buffer
+    conn.feed(data)
+    if process(conn):
+        new_head = True
+    arm_timeout(conn, new_head)
+    flush(sock)
+
+
+def process(conn: Connection):
+    """Generate responses to the complete requests in the buffer
+    until the outbound queue reaches the high-water mark, after EOF
+    mark the connection closing once the buffer is processed.
+    Return True if something was queued"""
+
+    client_addr = conn.addr
+    queued = 0
+
+    while not conn.closing and conn.pending < HIGH_WATER:
+        request = conn.next_request()
+        if request is None:
+            break
+
+        response, keep_alive = respond(*request, client_addr)
+        conn.queue(response)
+        queued += 1
+
+        if not keep_alive:
+            conn.closing = True
+
+    conn.paused = conn.pending >= HIGH_WATER
+    if conn.eof and not conn.paused:
+        # the rest of the buffer can't become a complete request
+        conn.closing = True
+
+    return bool(queued)
+
+
+def flush(sock: socket.socket):
+    """Send as much of the outbound queue as the socket takes
+    without blocking, resume reading below the low-water mark"""
+
+    conn = connections[sock]
+
+    while conn.outbox:
+        try:
+            sent = sock.sendmsg(list(islice(conn.outbox, IOV_MAX)))
+        except BlockingIOError:
+            break
+        except ConnectionError:
+            logger.debug("Client %s:%s has disconnected", *conn.addr)
             close(sock)
             return
 
-        if "Connection: close" in response.decode():
-            close(sock)
+        conn.pending -= sent
+        if sent:
+            set_deadline(conn, IDLE_TIMEOUT)
+        while sent:
+            chunk = conn.outbox[0]
+            if sent < len(chunk):
+                conn.outbox[0] = memoryview(chunk)[sent:]
+                break
+            sent -= len(chunk)
+            conn.outbox.popleft()
+        else:
+            continue
+        break
+
+    if conn.paused and conn.pending <= LOW_WATER:
+        conn.paused = False
+        if process(conn):
+            flush(sock)
+            return
 
-    else:
-        logger.debug("Client %s:%s has disconnected", *client_addr)
+    if conn.closing and not conn.outbox:
         close(sock)
+        return
 
+    update_events(conn)
 
-def parse_post(headers, body):
-    ''' We handle only trivial case here - only text form data'''
 
-    if 'application/x-www-form-urlencoded' in headers['content-type']:
-        return parse_qs(body)
+def respond(request, form, client_addr):
+    """Generate response to a single complete request,
+    return response buffers and keep-alive flag"""
 
-    if 'multipart/form-data' in headers['content-type']:
-        boundary = headers['content-type'].split('; boundary=', 1)[1]
-        pattern = f"-*{boundary}-*"
-        form_data = [part.strip() for part in re.split(pattern, body)]
-        params = {}
-        for part in form_data:
-            # ex: 'Content-Disposition: form-data; name="status"\r\n\r\n500\r\n'
-            param = re.match(r'.+name\=\"(.+)\"\s+(\S+)\s*', part)
-            if param:
-                params.update([param.groups()])
-        if params:
-            return parse_qs(urlencode(params))
+    started = time.perf_counter()
 
+    key = cached = None
+    if cache and not is_stats_request(request):
+        key = cache_key(request, form)
+        cached = cache.get(key)
 
-def parse_request(request):
-    """Parse client's request"""
+    if cached:
+        # only the client address part of the body is not cached
+        parsed_request, rendered = cached
+        response = assemble_response(*rendered, generate_source(client_addr))
+        generated = time.perf_counter()
 
-    startline: str = request.decode().split('\n', 1)[0]
+        stats.cache_hit.record(generated - started)
+
+    else:
+        parsed_request = parse_request(request, form)
+        parsed = time.perf_counter()
+
+        if parsed_request.get('path') == STATS_PATH and parsed_request['method'] == b'GET':
+            response = generate_stats_response(parsed_request)
+        else:
+            rendered = render(parsed_request)
+            response = assemble_response(*rendered, generate_source(client_addr))
+            if key is not None:
+                cache.put(key, (parsed_request, rendered),
+                          len(key[0]) + len(rendered[2]))
+        generated = time.perf_counter()
+
+        stats.parse.record(parsed - started)
+        stats.generate.record(generated - parsed)
+
+    size = sum(map(len, response))
+    if profiler:
+        profiler.count_request()
+    stats.requests[parsed_request.get('method', b'-'),
+                   parsed_request['status'].value] += 1
+    stats.bytes_out += size
+
+    if access_logger.isEnabledFor(logging.INFO):
+        access_logger.info(
+            'client=%s:%s method=%s url=%s status=%s bytes=%s latency_ms=%.3f',
+            *client_addr,
+            parsed_request.get('method', b'-').decode('latin-1'),
+            parsed_request.get('url', b'-').decode('latin-1'),
+            parsed_request['status'].value,
+            size,
+            (generated - started) * 1000)
+
+    return response, parsed_request['keep_alive']
+
+
+def is_stats_request(request):
+    """Whether the raw request is GET of the stats endpoint: metrics
+    are never cached and scrapes don't count as cache misses"""
+
+    prefix = b'GET ' + STATS_PATH
+
+    return (request.startswith(prefix) and
+            request[len(prefix):len(prefix) + 1] in (b' ', b'?'))
+
+
+def cache_key(request, form):
+    """Response cache key: request head with a digest of the body
+    or with the fields of the streamed form"""
+
+    head_end = request.find(HEAD_END) + len(HEAD_END)
+
+    if form is not None:
+        return (request[:head_end],
+                tuple((name, tuple(values)) for name, values in form.items()))
+
+    if head_end == len(request):
+        return (request, b'')
+
+    return (request[:head_end],
+            hashlib.blake2b(request[head_end:], digest_size=16).digest())
+
+
+def parse_post(headers, body):
+    '''Parse the whole form body at once'''
+
+    form = FormParser(headers[b'content-type'])
+    form.feed(body)
+
+    return form.close()
+
+
+def split_startline(startline: bytes):
+    """Split request start line, return None if it is not sane"""
 
-    # minimal sanity check
     try:
         method, url, schema = startline.split()
-        assert 'HTTP' in schema
+        assert b'HTTP' in schema
     except:
-        return {
-            'status': HTTPStatus.BAD_REQUEST,
-            'schema': 'HTTP/1.1',
-            'headers': {'Connection': 'close'}
-        }
+        return None
 
-    try:
-        assert method in ('GET', 'POST')
-    except AssertionError:
-        return {
-            'status': HTTPStatus.NOT_IMPLEMENTED,
-            'schema': schema,
-            'headers': {'Connection': 'close'}
-        }
+    return method, url, schema
 
-    raw_headers, body = request.decode().split('\r\n\r\n', 1)
 
-    headers = {}
+def error_request(status, schema=b'HTTP/1.1'):
+    """Parsed request state for the requests we refuse to serve"""
 
-    for header in raw_headers.split('\r\n'):
-        header = header.split(': ', 1)
-        if len(header) == 2:
-            header = Header(*header)
-            headers[header.name.lower()] = header.value
+    return {
+        'status': status,
+        'schema': schema,
+        'headers': {b'connection': b'close'},
+        'keep_alive': False
+    }
+
+
+def parse_request(request: bytes, form=None):
+    """Parse client's request, form fields may be
+    already parsed from the streamed body"""
+
+    head_end = request.find(HEAD_END)
+    line_end = request.find(b'\n', 0, head_end)
+    startline = split_startline(request[:line_end])
+
+    # minimal sanity check
+    if not startline or head_end < 0:
+        return error_request(HTTPStatus.BAD_REQUEST)
 
-    url_parsed = urlparse(url)
+    method, url, schema = startline
+
+    if method not in METHODS:
+        return error_request(HTTPStatus.NOT_IMPLEMENTED, schema)
+
+    headers = {}
+
+    for header in request[line_end + 1:head_end].split(b'\r\n'):
+        name, sep, value = header.partition(b': ')
+        if sep:
+            headers[name.lower()] = value
+
+    if b'content-length' in headers:
+        try:
+            size = int(headers[b'content-length'])
+            assert size >= 0
+        except (ValueError, AssertionError):
+            return error_request(HTTPStatus.BAD_REQUEST, schema)
+        if size > (MAX_BODY_SIZE if form is None else MAX_UPLOAD_SIZE):
+            return error_request(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, schema)
+
+    path, _, query = url.partition(b'?')
     qs_parsed = None
 
-    if method == 'GET':
-        qs_parsed = parse_qs(url_parsed.query)
+    if method == b'GET':
+        qs_parsed = parse_qs(query.decode(errors='replace'))
+
+    elif form is not None:
+        qs_parsed = form
 
-    elif method == 'POST' and headers.get('content-type'):
-        qs_parsed = parse_post(headers, body)
+    elif method == b'POST' and headers.get(b'content-type'):
+        qs_parsed = parse_post(
+            headers, memoryview(request)[head_end + len(HEAD_END):])
 
     try:
         code = int(qs_parsed['status'][0])
     except:
         code = 200
 
-    status = find_http_status(code)
-    if not status:
-        status = HTTPStatus.OK
-
     return {
-        'status': status,
+        'status': STATUSES.get(code, HTTPStatus.OK),
         'schema': schema,
         'method': method,
         'url': url,
-        'url_parsed': url_parsed,
+        'path': path,
         'qs_parsed': qs_parsed,
-        'headers': headers
+        'headers': headers,
+        'keep_alive': b'keep-alive' in headers.get(b'connection', b'').lower()
     }
 
 
 def generate_headers(request):
     '''Generate response headers'''
 
-    headers = {}
+    return RESPONSE_HEADERS[request['keep_alive']]
 
-    if 'keep-alive' in request['headers'].values():
-        headers.update({"Connection": "keep-alive"})
-    else:
-        headers.update({"Connection": "close"})
 
-    headers.update({"Content-Type": "text/html"})
+def generate_source(client_addr):
+    '''Generate the client address part of response content'''
 
-    return '\n'.join([f"{k}: {v}" for k, v in headers.items()])
+    return b"<h4>Request source: %s:%d</h4>" % (client_addr[0].encode(), client_addr[1])
 
 
-def generate_content(request, client_addr):
-    '''Generate response content'''
+def generate_details(request):
+    '''Generate the request dependent part of response content'''
 
     content = []
-    status = request['status']
-
-    content.append("<h4>Request source: {}:{}</h4>".format(*client_addr))
 
     if request.get('method'):
-        content.append(f"<h4>Request method: {request['method']}</h4>")
+        content.append(b"<h4>Request method: %s</h4>" % request['method'])
 
-    content.append(f"<h4>Response status: {status.value} {status.phrase}</h4>")
+    content.append(b"<h4>Response status: %s</h4>" %
+                   STATUS_TEXT[request['status']])
 
     if request.get('headers'):
-        content.append("<h3>Request headers:</h3>")
-        content.extend([f"<h4>{k.capitalize()}: {v}</h4>" for k,
+        content.append(b"<h3>Request headers:</h3>")
+        content.extend([b"<h4>%s: %s</h4>" % (k.capitalize(), v) for k,
                         v in request['headers'].items()])
 
     if request.get('qs_parsed'):
-        content.append("<h3>Request parameters:</h3>")
-        content.extend([f"<h4>{k}: {v}</h4>" for k,
+        content.append(b"<h3>Request parameters:</h3>")
+        content.extend([f"<h4>{k}: {v}</h4>".encode() for k,
                         v in request['qs_parsed'].items()])
 
-    return ''.join(content)
+    return b''.join(content)
 
 
 def generate_startline(request):
     '''Generate response start line'''
 
-    return f"{request['schema']} {request['status'].value} {request['status'].phrase}\n"
+    return request['schema'] + STATUS_LINES[request['status']]
+
+
+def render(request):
+    '''Generate the response parts which do not depend on the client'''
+
+    return generate_startline(request), generate_headers(request), generate_details(request)
+
+
+def assemble_response(startline, headers, details, source):
+    '''Put response parts together as buffers for scatter-gather send'''
+
+    return [
+        startline,
+        headers,
+        b"Content-length: %d\r\n\r\n" % (len(source) + len(details)),
+        source,
+        details
+    ]
 
 
 def generate_response(request, client_addr):
-    '''Generate response'''
+    '''Generate response buffers for scatter-gather send'''
+
+    return assemble_response(*render(request), generate_source(client_addr))
 
-    parsed_request = parse_request(request)
 
-    startline = generate_startline(parsed_request)
-    body = generate_content(parsed_request, client_addr)
-    headers = generate_headers(parsed_request)
-    headers += f"\nContent-length: {len(body)}\n\n"
+def generate_stats_response(request):
+    '''Generate response with runtime metrics of the process'''
 
-    return (startline + headers + body).encode()
+    body = stats.exposition()
+
+    return [
+        generate_startline(request),
+        STATS_HEADERS[request['keep_alive']],
+        b"Content-length: %d\r\n\r\n" % len(body),
+        body
+    ]
 
 
 def event_loop():
     '''Run event loop based on selectors module'''
 
     while True:
-        for key, mask in selector.select():  # key: SelectorKey, events: selectors.EVENT_READ
+        for key, mask in selector.select(TICK):  # key: SelectorKey, events: selectors.EVENT_READ
             callback = key.data
             sock = key.fileobj
             callback(sock, mask)
 
+        expire_connections(lambda conn: close(conn.sock))
+        check_profiler()
+
+
+class EchoProtocol(asyncio.Protocol):
+    '''Client connection handler for the asyncio engine'''
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+        self.conn = Connection(
+            transport.get_extra_info('socket'), self.addr, transport)
+        self.paused = False
+        transport.set_write_buffer_limits(high=HIGH_WATER, low=LOW_WATER)
+        logger.debug('Accepted connection from %s:%s', *self.addr)
+        stats.accepted += 1
+
+        if MAX_CONNECTIONS and len(connections) >= MAX_CONNECTIONS:
+            logger.debug('Connection limit %s reached, refusing %s:%s',
+                         MAX_CONNECTIONS, *self.addr)
+            transport.writelines(generate_response(
+                error_request(HTTPStatus.SERVICE_UNAVAILABLE), self.addr))
+            transport.close()
+            return
+
+        connections[self] = self.conn
+        set_deadline(self.conn, HEADER_TIMEOUT)
+
+    def data_received(self, data):
+        stats.bytes_in += len(data)
+        new_head = not self.conn.buffer
+        self.conn.feed(data)
+        if self.process():
+            new_head = True
+        arm_timeout(self.conn, new_head)
+
+    def process(self):
+        '''Write responses to the complete requests in the buffer
+        until the transport asks to pause.
+        Return True if something was written'''
+
+        written = False
+
+        while not self.paused and not self.transport.is_closing():
+            request = self.conn.next_request()
+            if request is None:
+                break
+
+            response, keep_alive = respond(*request, self.addr)
+            self.transport.writelines(response)
+            written = True
+
+            if not keep_alive:
+                self.transport.close()
+
+        return written
+
+    def pause_writing(self):
+        self.paused = True
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.paused = False
+        self.transport.resume_reading()
+        self.process()
+
+    def eof_received(self):
+        logger.debug("Client %s:%s has disconnected", *self.addr)
+
+    def connection_lost(self, exc):
+        logger.debug("Closing connection from %s:%s", *self.addr)
+        stats.closed += 1
+        if connections.pop(self, None):
+            timers.remove(self.conn)
+
+
+async def expire_transports():
+    '''Drop timed out connections of the asyncio engine'''
+
+    while True:
+        await asyncio.sleep(TICK)
+        expire_connections(lambda conn: conn.transport.abort())
+        check_profiler()
+
+
+async def serve(host, port):
+    '''Run TCP server on asyncio event loop'''
+
+    loop = asyncio.get_running_loop()
+    server_socket = listen_socket(host, port)
+    expiry = asyncio.create_task(expire_transports())
+
+    async with await loop.create_server(EchoProtocol, sock=server_socket) as srv:
+        await srv.serve_forever()
+
+    expiry.cancel()
+
+
+def run(host, port):
+    '''Run server with the selected engine'''
+
+    if PROFILE:
+        init_profiler()
+
+    if ENGINE == 'asyncio':
+        if uvloop:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.debug('Using %s event loop',
+                     'uvloop' if uvloop else 'asyncio')
+        asyncio.run(serve(host, port))
+    else:
+        server(host, port)
+        event_loop()
+
+
+def worker(host, port, num):
+    '''Run server in a forked worker process with its own
+    listening socket and selector'''
+
+    global selector
+    init_logger(f'ECHO-{num}')
+    selector = selectors.DefaultSelector()
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    run(host, port)
+
+
+def supervisor(host, port, workers):
+    '''Fork worker processes sharing the port via SO_REUSEPORT,
+    restart the ones that die. Workers failing at startup are restarted
+    with a growing delay, the supervisor exits if one keeps failing'''
+
+    children = {}
+    started = {}
+    failures = [0] * workers
+    # worker number: time of the delayed restart
+    pending = {}
+    stopping = False
+    failed = False
+
+    def spawn(num):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                worker(host, port, num)
+            except BaseException:
+                logger.exception('Worker %s failed', num)
+                code = 1
+            finally:
+                stop_logger()
+                os._exit(code)
+        children[pid] = num
+        started[num] = time.monotonic()
+        logger.info('Started worker %s with pid %s', num, pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        pending.clear()
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def restart(num):
+        nonlocal failed
+        if time.monotonic() - started[num] >= MIN_UPTIME:
+            failures[num] = 0
+            spawn(num)
+            return
+        failures[num] += 1
+        if failures[num] >= MAX_START_FAILURES:
+            logger.error('Worker %s failed at startup %s times in a row, '
+                         'stopping', num, failures[num])
+            failed = True
+            stop(None, None)
+            return
+        delay = min(RESTART_DELAY * 2 ** (failures[num] - 1), MAX_RESTART_DELAY)
+        logger.info('Restarting worker %s in %.1f s', num, delay)
+        pending[num] = time.monotonic() + delay
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for num in range(workers):
+        spawn(num)
+
+    while children or pending:
+        if pending:
+            # poll while restarts are due, signals don't interrupt sleep
+            now = time.monotonic()
+            for num, due in list(pending.items()):
+                if due <= now:
+                    del pending[num]
+                    spawn(num)
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid = 0
+            if not pid:
+                time.sleep(TICK / 10)
+                continue
+        else:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+        num = children.pop(pid, None)
+        if num is None:
+            continue
+        logger.info('Worker %s with pid %s exited with status %s',
+                     num, pid, os.waitstatus_to_exitcode(status))
+        if not stopping:
+            restart(num)
+
+    if failed:
+        sys.exit(1)
+
 
 def main():
 
     init_logger('ECHO')
-    server(HOST, PORT)
-    event_loop()
+    atexit.register(stop_logger)
+
+    if WORKERS > 0:
+        supervisor(HOST, PORT, WORKERS)
+    else:
+        run(HOST, PORT)
 
 
 if __name__ == '__main__':
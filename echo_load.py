@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+import socket
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from collections import Counter
+from http import HTTPStatus
+from itertools import cycle
+from math import ceil
+from multiprocessing import Pool
+from pathlib import Path
+
+'''
+Генератор нагрузки для echo_http.py: держит заданное число соединений к
+серверу на localhost, отправляет запросы (с конвейеризацией или без) и
+выводит RPS, перцентили задержки и число ошибок в формате json.
+'''
+
+parser = ArgumentParser()
+parser.add_argument('--host', default='127.0.0.1')
+parser.add_argument('--port', type=int, default=9000)
+parser.add_argument('--concurrency', type=int, default=50)
+parser.add_argument('--requests', type=int, default=10000)
+parser.add_argument('--duration', type=float, default=None)
+parser.add_argument('--close', action='store_true')
+parser.add_argument('--pipeline', type=int, default=1)
+parser.add_argument('--kind', choices=('get', 'urlencoded', 'multipart'),
+                    default='get')
+parser.add_argument('--status', default='200')
+parser.add_argument('--clients', type=int, default=1)
+parser.add_argument('--timeout', type=float, default=10)
+parser.add_argument('--spawn', action='store_true')
+parser.add_argument('--server-args', default='')
+parser.add_argument('--to-file', nargs='?',
+                    const='echo_load.json', default=None)
+args = parser.parse_args()
+
+BOUNDARY = 'echo-load-boundary'
+VALID_STATUSES = {status.value for status in HTTPStatus}
+
+
+def build_request(kind, status, keep_alive):
+    """Build raw request bytes for the given kind and status parameter"""
+
+    connection = 'keep-alive' if keep_alive else 'close'
+
+    if kind == 'get':
+        return (f'GET /?status={status} HTTP/1.1\r\n'
+                f'Host: localhost\r\n'
+                f'Connection: {connection}\r\n\r\n').encode()
+
+    if kind == 'urlencoded':
+        content_type = 'application/x-www-form-urlencoded'
+        body = f'status={status}&name=echo-load'
+    else:
+        content_type = f'multipart/form-data; boundary={BOUNDARY}'
+        body = (f'--{BOUNDARY}\r\n'
+                f'Content-Disposition: form-data; name="status"\r\n\r\n'
+                f'{status}\r\n'
+                f'--{BOUNDARY}\r\n'
+                f'Content-Disposition: form-data; name="name"\r\n\r\n'
+                f'echo-load\r\n'
+                f'--{BOUNDARY}--\r\n')
+
+    return (f'POST / HTTP/1.1\r\n'
+            f'Host: localhost\r\n'
+            f'Connection: {connection}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Length: {len(body)}\r\n\r\n{body}').encode()
+
+
+def expected_status(status):
+    """Status the server should answer with"""
+
+    return status if status in VALID_STATUSES else 200
+
+
+async def read_response(reader):
+    """Read one response, return its status code"""
+
+    head = await reader.readuntil(b'\r\n\r\n')
+    status = int(head.split(b' ', 2)[1])
+    size = 0
+    for line in head.split(b'\r\n'):
+        name, _, value = line.partition(b':')
+        if name.lower() == b'content-length':
+            size = int(value)
+    await reader.readexactly(size)
+
+    return status
+
+
+async def connection(cfg, requests, budget, result):
+    """Send batches of requests over one connection (or one connection
+    per batch in close mode) until the budget is spent"""
+
+    reader = writer = None
+    depth = 1 if cfg['close'] else cfg['pipeline']
+    deadline = cfg['deadline']
+
+    while True:
+        if deadline:
+            if time.monotonic() >= deadline:
+                break
+            batch = depth
+        else:
+            if budget[0] <= 0:
+                break
+            batch = min(depth, budget[0])
+            budget[0] -= batch
+
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(
+                    cfg['host'], cfg['port'])
+
+            sent = [next(requests) for _ in range(batch)]
+            started = time.perf_counter()
+            writer.write(b''.join(request for request, _ in sent))
+
+            for _, expected in sent:
+                status = await asyncio.wait_for(
+                    read_response(reader), cfg['timeout'])
+                result['latencies'].append(time.perf_counter() - started)
+                result['statuses'][status] += 1
+                if status != expected:
+                    result['errors']['unexpected_status'] += 1
+
+        except (OSError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, asyncio.TimeoutError, ValueError) as e:
+            result['errors'][type(e).__name__] += 1
+            if writer:
+                writer.close()
+            reader = writer = None
+            continue
+
+        if cfg['close']:
+            writer.close()
+            reader = writer = None
+
+    if writer:
+        writer.close()
+
+
+async def run_client(cfg):
+    """Run concurrent connections of one client process"""
+
+    keep_alive = not cfg['close']
+    requests = cycle([(build_request(cfg['kind'], status, keep_alive),
+                       expected_status(status)) for status in cfg['statuses']])
+    result = {'latencies': [], 'statuses': Counter(), 'errors': Counter()}
+    budget = [cfg['requests']]
+
+    await asyncio.gather(*(connection(cfg, requests, budget, result)
+                           for _ in range(cfg['concurrency'])))
+
+    return result
+
+
+def client(cfg):
+    """Client process entry point"""
+
+    return asyncio.run(run_client(cfg))
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values"""
+
+    if not values:
+        return None
+
+    return values[max(ceil(len(values) * p / 100) - 1, 0)]
+
+
+def wait_for_port(host, port, timeout=10):
+    """Wait until the server accepts connections"""
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+
+    print(f"Server at {host}:{port} is not responding")
+    exit(1)
+
+
+def spawn_server():
+    """Start echo_http.py next to this script"""
+
+    script = Path(__file__).with_name('echo_http.py')
+    cmd = [sys.executable, str(script), '--host', args.host,
+           '--port', str(args.port), '--log-level', 'WARNING',
+           *args.server_args.split()]
+
+    return subprocess.Popen(cmd)
+
+
+def prepare_report(results, elapsed):
+    """Merge client results into json report"""
+
+    latencies = sorted(lat for r in results for lat in r['latencies'])
+    statuses = sum((r['statuses'] for r in results), Counter())
+    errors = sum((r['errors'] for r in results), Counter())
+
+    return {
+        'config': {
+            'concurrency': args.concurrency,
+            'clients': args.clients,
+            'keep_alive': not args.close,
+            'pipeline': 1 if args.close else args.pipeline,
+            'kind': args.kind,
+            'status': args.status,
+            'server_args': args.server_args if args.spawn else None,
+        },
+        'requests': len(latencies),
+        'elapsed': round(elapsed, 3),
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'latency_ms': {
+            name: round(percentile(latencies, p) * 1000, 3) if latencies else None
+            for name, p in (('p50', 50), ('p95', 95), ('p99', 99), ('max', 100))
+        },
+        'statuses': {str(k): v for k, v in sorted(statuses.items())},
+        'errors': dict(errors),
+    }
+
+
+def main():
+
+    server = None
+    if args.spawn:
+        server = spawn_server()
+    wait_for_port(args.host, args.port)
+
+    clients = max(args.clients, 1)
+    cfgs = [{
+        'host': args.host,
+        'port': args.port,
+        'close': args.close,
+        'pipeline': max(args.pipeline, 1),
+        'kind': args.kind,
+        'statuses': [int(s) for s in args.status.split(',')],
+        'timeout': args.timeout,
+        'concurrency': args.concurrency // clients + (n < args.concurrency % clients),
+        'requests': args.requests // clients + (n < args.requests % clients),
+        'deadline': None,
+    } for n in range(clients)]
+
+    try:
+        start = time.perf_counter()
+        if args.duration:
+            deadline = time.monotonic() + args.duration
+            for cfg in cfgs:
+                cfg['deadline'] = deadline
+        if clients > 1:
+            with Pool(clients) as pool:
+                results = pool.map(client, cfgs)
+        else:
+            results = [client(cfgs[0])]
+        elapsed = time.perf_counter() - start
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    rep = prepare_report(results, elapsed)
+
+    print(json.dumps(rep, indent=4))
+
+    if args.to_file:
+        try:
+            with open(args.to_file, 'w') as f:
+                json.dump(rep, f, indent=4)
+        except Exception as e:
+            print(e)
+            exit(1)
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+'''
+Сравнение logparse_re.py и logparse_pd.py на синтетических логах loggen.py:
+для каждого размера лога и каждого варианта запуска измеряет время работы,
+число строк в секунду и пиковый RSS, результаты сохраняет в json.
+'''
+
+parser = ArgumentParser()
+parser.add_argument('--sizes', default='1K,100K,1M,10M')
+parser.add_argument('--run', action='append', default=None)
+parser.add_argument('--repeat', type=int, default=1)
+parser.add_argument('--dir', default='bench_logs')
+parser.add_argument('--hosts', type=int, default=1000)
+parser.add_argument('--malformed', type=float, default=0.0)
+parser.add_argument('--compress', choices=('gz', 'bz2', 'xz'), default=None)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--timeout', type=float, default=None)
+parser.add_argument('--to-file', default='logbench.json')
+args = parser.parse_args()
+
+HERE = Path(__file__).resolve().parent
+# compared scripts and options, --jobs 0 is a worker per CPU
+RUNS = ('logparse_re.py --engine split',
+        'logparse_re.py --engine re',
+        'logparse_re.py --engine mmap',
+        'logparse_re.py --jobs 0',
+        'logparse_pd.py',
+        'logparse_pd.py --chunksize 100000',
+        'logparse_pd.py --jobs 0')
+SUFFIXES = {'K': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9}
+
+
+def parse_size(text):
+    """Number of lines given as 1000, 100K or 10M"""
+
+    text = text.strip().upper()
+    if text[-1:] in SUFFIXES:
+        return int(float(text[:-1]) * SUFFIXES[text[-1]])
+
+    return int(text)
+
+
+def log_path(lines):
+    """Log of the given size generated with the benchmark options,
+    generated once: loggen.py output depends only on its arguments"""
+
+    name = (f'access_{lines}_h{args.hosts}_m{args.malformed}_s{args.seed}.log' +
+            (f'.{args.compress}' if args.compress else ''))
+    path = Path(args.dir) / name
+    if path.exists():
+        return path
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + '.tmp')
+    cmd = [sys.executable, str(HERE / 'loggen.py'), '--lines', str(lines),
+           '--out', str(tmp), '--hosts', str(args.hosts),
+           '--malformed', str(args.malformed), '--seed', str(args.seed)]
+    if args.compress:
+        cmd += ['--compress', args.compress]
+
+    print(f'Generating {path}')
+    subprocess.run(cmd, check=True)
+    os.replace(tmp, path)
+
+    return path
+
+
+def measure(cmd):
+    """Run command, return exit code, wall time and peak RSS in KB.
+    RSS of the child includes its waited for children (pool workers)
+    as a maximum of a single process, not a sum"""
+
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    timer = None
+    if args.timeout:
+        timer = threading.Timer(args.timeout, proc.kill)
+        timer.start()
+
+    _, status, usage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - start
+    if timer:
+        timer.cancel()
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    return proc.returncode, wall, usage.ru_maxrss
+
+
+def bench(lines, path, run):
+    """Result of the best of --repeat runs of the command over the log"""
+
+    script, *options = shlex.split(run)
+    cmd = [sys.executable, str(HERE / script), '--file', str(path), *options]
+
+    walls, rss, code = [], 0, 0
+    for _ in range(args.repeat):
+        code, wall, peak = measure(cmd)
+        walls.append(round(wall, 3))
+        rss = max(rss, peak)
+        if code:
+            break
+
+    best = min(walls)
+
+    return {'lines': lines,
+            'run': run,
+            'returncode': code,
+            'wall_s': best,
+            'walls_s': walls,
+            'lines_per_s': round(lines / best),
+            'max_rss_mb': round(rss / 1024, 1)}
+
+
+def main():
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    runs = args.run or RUNS
+
+    results = []
+    for lines in sizes:
+        path = log_path(lines)
+        for run in runs:
+            r = bench(lines, path, run)
+            results.append(r)
+            status = '' if r['returncode'] == 0 else f" exit {r['returncode']}"
+            print(f"{lines:>10} {run:<36} {r['wall_s']:9.3f} s "
+                  f"{r['lines_per_s']:>10} lines/s "
+                  f"{r['max_rss_mb']:8.1f} MB{status}")
+
+    rep = {'python': sys.version.split()[0],
+           'cpus': os.cpu_count(),
+           'log': {'hosts': args.hosts, 'malformed': args.malformed,
+                   'compress': args.compress, 'seed': args.seed},
+           'repeat': args.repeat,
+           'results': results}
+
+    try:
+        with open(args.to_file, 'w') as f:
+            json.dump(rep, f, indent=4)
+    except Exception as e:
+        print(e)
+        exit(1)
+
+
+if __name__ == '__main__':
+
+    main()
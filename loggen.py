@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import bz2
+import gzip
+import lzma
+import random
+from argparse import ArgumentParser
+from itertools import accumulate
+from time import gmtime, strftime
+
+from logparse_common import parse_time
+
+'''
+Генератор синтетических логов в формате combined (с длительностью запроса
+%D в конце строки) для проверки и сравнения logparse_re.py и logparse_pd.py.
+При одинаковых аргументах и --seed генерируется один и тот же файл.
+'''
+
+parser = ArgumentParser()
+parser.add_argument('--lines', type=int, default=1000)
+parser.add_argument('--out', default='access.log')
+parser.add_argument('--hosts', type=int, default=1000)
+parser.add_argument('--urls', type=int, default=200)
+parser.add_argument('--malformed', type=float, default=0.0)
+parser.add_argument('--compress', choices=('gz', 'bz2', 'xz'), default=None)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--start', type=parse_time,
+                    default=parse_time('12/Dec/2015:00:00:00 +0100'))
+parser.add_argument('--rps', type=float, default=20)
+args = parser.parse_args()
+
+OPENERS = {None: open, 'gz': gzip.open, 'bz2': bz2.open, 'xz': lzma.open}
+# lines are generated and written in batches of this size
+BATCH = 10000
+# local time of the log
+ZONE = '+0100'
+ZONE_SECONDS = 3600
+
+METHODS = ('GET', 'POST', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+METHOD_WEIGHTS = (80, 12, 3, 2, 2, 1)
+STATUSES = ('200', '301', '304', '404', '500', '503')
+STATUS_WEIGHTS = (80, 5, 5, 6, 3, 1)
+USERS = ('-', '-', '-', 'bob', 'alice')
+AGENTS = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) '
+          'Gecko/20100101 Firefox/115.0',
+          'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 '
+          '(KHTML, like Gecko) Chrome/120.0 Safari/537.36',
+          'curl/7.88.1',
+          'python-requests/2.31.0',
+          '-')
+SECTIONS = ('', 'index.php', 'images/', 'administrator/', 'api/v1/items/',
+            'search?q=', 'static/css/', 'news/')
+
+
+def zipf_weights(n):
+    """Cumulative weights of n keys with frequency falling as 1 / rank:
+    a few hosts and urls make most of the requests, as in real logs"""
+
+    return list(accumulate(1 / rank for rank in range(1, n + 1)))
+
+
+def host_name(n):
+    """Distinct address of the n-th host"""
+
+    return f'10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}'
+
+
+def url_name(n):
+    """Distinct path of the n-th url"""
+
+    section = SECTIONS[n % len(SECTIONS)]
+    return f'/{section}{n}' if section else f'/{n}'
+
+
+def malformed_line(rng, line):
+    """Broken variant of a valid line: garbage, a line cut after status
+    (without referer, user agent and duration) or an unknown method"""
+
+    kind = rng.randrange(3)
+    if kind == 0:
+        return f'garbage line {rng.randrange(10 ** 6)} without format'
+    if kind == 1:
+        return line[:line.index('"', line.index('" ') + 1)].rstrip()
+    return line.replace('"', '"BREW ', 1)
+
+
+def gen_lines(rng):
+    """Yield batches of log lines"""
+
+    hosts = [host_name(n) for n in range(args.hosts)]
+    host_weights = zipf_weights(args.hosts)
+    urls = [url_name(n) for n in range(args.urls)]
+    url_weights = zipf_weights(args.urls)
+
+    step = 1 / args.rps
+    local = args.start + ZONE_SECONDS
+    # time formatting is the slowest part, a second is formatted once
+    stamp_second, stamp = None, None
+
+    done = 0
+    while done < args.lines:
+        size = min(BATCH, args.lines - done)
+        batch = []
+        for host, url, method, status in zip(
+                rng.choices(hosts, cum_weights=host_weights, k=size),
+                rng.choices(urls, cum_weights=url_weights, k=size),
+                rng.choices(METHODS, weights=METHOD_WEIGHTS, k=size),
+                rng.choices(STATUSES, weights=STATUS_WEIGHTS, k=size)):
+            # requests are logged when they end: times are nearly ordered
+            second = int(local + max(done * step - rng.random() * 2, 0))
+            if second != stamp_second:
+                stamp_second = second
+                stamp = strftime('%d/%b/%Y:%H:%M:%S', gmtime(second))
+            size_field = ('-' if status in ('304', '500')
+                          else rng.randrange(100, 100000))
+            referer = rng.choice(('-', 'http://example.com' + url))
+            line = (f'{host} - {rng.choice(USERS)} [{stamp} {ZONE}] '
+                    f'"{method} {url} HTTP/1.1" {status} {size_field} '
+                    f'"{referer}" "{rng.choice(AGENTS)}" '
+                    f'{int(rng.expovariate(1 / 200))}')
+            if args.malformed and rng.random() < args.malformed:
+                line = malformed_line(rng, line)
+            batch.append(line)
+            done += 1
+        yield batch
+
+
+def main():
+    rng = random.Random(args.seed)
+
+    with OPENERS[args.compress](args.out, 'wt') as f:
+        for batch in gen_lines(rng):
+            f.write('\n'.join(batch))
+            f.write('\n')
+
+
+if __name__ == '__main__':
+
+    main()
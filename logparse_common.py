@@ -0,0 +1,775 @@
+import bz2
+import calendar
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import lzma
+import os
+import pickle
+import shutil
+import subprocess
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from math import ceil
+from operator import itemgetter
+from pathlib import Path
+from time import gmtime, strftime
+
+'''
+Общие функции скриптов разбора логов logparse_re.py и logparse_pd.py
+'''
+
+# files smaller than this are not split between workers
+MIN_CHUNK = 16 * 1024 * 1024
+BUFFER_SIZE = 1024 * 1024
+
+MAGIC = ((b'\x1f\x8b', 'gz'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'xz'))
+# external decompressors in order of preference, parallel ones first
+DECOMPRESSORS = {'gz': ('pigz', 'gzip'),
+                 'bz2': ('lbzip2', 'pbzip2', 'bzip2'),
+                 'xz': ('xz',)}
+MODULES = {'gz': gzip, 'bz2': bz2, 'xz': lzma}
+# files are recognized in --state mode by a hash of their first bytes
+HEAD_SIZE = 4096
+STATE_VERSION = 1
+PERCENTILES = (50, 95, 99)
+# --bucket window sizes in seconds
+BUCKETS = {'1m': 60, '5m': 300, '1h': 3600}
+MONTHS = {month: n for n, month in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+     'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
+LOG_TIME_FORMAT = '%d/%b/%Y:%H:%M:%S %z'
+# logs are only nearly time-ordered: a request is logged when it ends,
+# with the time it started. --since/--until seek this much wider
+DISORDER = 300
+# bisection stops and scans lines when the range is this small
+SEEK_BLOCK = 64 * 1024
+# sidecar time index of --index has a point every INDEX_STEP bytes
+INDEX_STEP = 16 * 1024 * 1024
+# fields of --group-by keys and numeric fields of --agg functions
+GROUP_FIELDS = ('host', 'user', 'method', 'url', 'status', 'referer', 'ua')
+AGG_FIELDS = ('bytes', 'duration')
+AGG_OPS = ('count', 'sum', 'min', 'max', 'avg')
+
+
+# UTC epoch by minute and zone of request time, see minute_epoch()
+minutes = {}
+
+
+def minute_epoch(time):
+    """UTC epoch of the minute of "dd/Mon/yyyy:HH:MM:SS +zzzz" request
+    time, None if it's malformed. Times of one minute share the cache
+    entry, so strptime-like parsing runs once per distinct minute"""
+
+    key = time[:17] + time[20:]
+    try:
+        return minutes[key]
+    except KeyError:
+        pass
+
+    try:
+        epoch = calendar.timegm((int(time[7:11]), MONTHS[time[3:6]],
+                                 int(time[:2]), int(time[12:14]),
+                                 int(time[15:17]), 0))
+        offset = int(time[22:24]) * 3600 + int(time[24:26]) * 60
+        epoch -= offset if time[21] == '+' else -offset
+    except (ValueError, KeyError, IndexError):
+        epoch = None
+    minutes[key] = epoch
+
+    return epoch
+
+
+def log_time(time):
+    """UTC epoch of "dd/Mon/yyyy:HH:MM:SS +zzzz" request time,
+    None if it's malformed"""
+
+    epoch = minute_epoch(time)
+    if epoch is None:
+        return None
+    try:
+        return epoch + int(time[18:20])
+    except ValueError:
+        return None
+
+
+def parse_time(text):
+    """Epoch of --since/--until given in log format (12/Dec/2015:14:00:00
+    +0100) or ISO 8601 (2015-12-12T14:00:00+01:00), naive time is UTC"""
+
+    for parse in (lambda t: datetime.strptime(t, LOG_TIME_FORMAT),
+                  datetime.fromisoformat):
+        try:
+            dt = parse(text)
+        except ValueError:
+            continue
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return dt.timestamp()
+
+    raise ValueError(f"invalid time: {text}")
+
+
+def in_window(epoch, since, until):
+    """Whether time falls into [since, until)"""
+
+    return epoch is not None and (since is None or epoch >= since) \
+        and (until is None or epoch < until)
+
+
+def jobs_count(jobs):
+    """Number of worker processes, 0 means one per CPU"""
+
+    return jobs if jobs > 0 else os.cpu_count() or 1
+
+
+def compression(file):
+    """Compression format of the file by its magic bytes, None if plain"""
+
+    with open(file, 'rb') as f:
+        head = f.read(6)
+
+    for magic, kind in MAGIC:
+        if head.startswith(magic):
+            return kind
+
+    return None
+
+
+def decompressor(kind):
+    """Command line of an external decompressor, None if none installed"""
+
+    for name in DECOMPRESSORS[kind]:
+        path = shutil.which(name)
+        if path:
+            return [path, '-dc']
+
+    return None
+
+
+class RangeReader(io.RawIOBase):
+    """Raw stream of an open file ending at byte end"""
+
+    def __init__(self, f, end):
+        self.f = f
+        self.left = end - f.tell()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.left <= 0:
+            return 0
+        n = self.f.readinto(memoryview(b)[:self.left])
+        self.left -= n
+        return n
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+
+@contextmanager
+def open_log(file, mode='rb', start=0, end=None):
+    """Open log as a buffered stream ('rb' or 'r') of the content from
+    start byte up to end byte (plain files only). Compressed logs are
+    decompressed by a child process writing to a pipe, so decompression
+    runs in parallel with parsing; without an external tool the standard
+    library module is used"""
+
+    kind = compression(file)
+    proc = None
+
+    if kind is None:
+        stream = open(file, 'rb', buffering=BUFFER_SIZE)
+        stream.seek(start)
+        if end is not None:
+            stream = io.BufferedReader(RangeReader(stream, end), BUFFER_SIZE)
+    else:
+        cmd = decompressor(kind)
+        if cmd:
+            proc = subprocess.Popen(cmd + [str(file)], stdout=subprocess.PIPE,
+                                    bufsize=BUFFER_SIZE)
+            stream = proc.stdout
+        else:
+            stream = io.BufferedReader(MODULES[kind].open(file, 'rb'),
+                                       BUFFER_SIZE)
+
+    try:
+        if kind is not None:
+            skip(stream, start)
+        yield io.TextIOWrapper(stream) if mode == 'r' else stream
+    except BaseException:
+        if proc:
+            proc.kill()
+        raise
+    finally:
+        stream.close()
+        if proc and proc.wait() > 0:
+            raise OSError(f"{cmd[0]} failed to decompress {file}")
+
+
+def skip(stream, size):
+    """Read and drop size bytes of the stream"""
+
+    while size > 0:
+        data = stream.read(min(size, BUFFER_SIZE))
+        if not data:
+            break
+        size -= len(data)
+
+
+def split_range(file, start, end, chunk_size):
+    """Split byte range of the file into ranges of about chunk_size
+    with every range starting at a line start"""
+
+    bounds = [start]
+
+    with open(file, 'rb') as f:
+        pos = start + chunk_size
+        while pos < end:
+            f.seek(pos)
+            f.readline()
+            pos = f.tell()
+            if pos >= end:
+                break
+            bounds.append(pos)
+            pos += chunk_size
+
+    bounds.append(end)
+
+    return [(file, start, end) for start, end in zip(bounds, bounds[1:])
+            if end > start]
+
+
+def split_tasks(ranges, jobs):
+    """Split (file, start, end) ranges into tasks: big plain ranges are
+    split to keep all workers busy, compressed files (end is None)
+    can't be split"""
+
+    tasks = []
+    for file, start, end in ranges:
+        if end is None:
+            tasks.append((file, start, end))
+            continue
+        chunk_size = max(MIN_CHUNK, -(-(end - start) // jobs))
+        tasks.extend(split_range(file, start, end, chunk_size))
+
+    return tasks
+
+
+def make_tasks(files, jobs, since=None, until=None, index=False):
+    """Split files into (file, start, end) tasks: a file per task,
+    big plain files are split into byte ranges, compressed ones
+    are read whole (end is None). With since/until plain files are
+    narrowed to the byte range of the time window"""
+
+    ranges = []
+    for file in files:
+        if compression(file):
+            ranges.append((file, 0, None))
+        elif since is None and until is None:
+            ranges.append((file, 0, os.path.getsize(file)))
+        else:
+            ranges.append((file, *window_range(file, since, until, index)))
+
+    return split_tasks(ranges, jobs)
+
+
+def gen_range_lines(file, start, end):
+    """Yield decoded lines of the byte range, of the whole
+    (possibly compressed) file if end is None"""
+
+    if end is None:
+        with open_log(file, 'r', start) as f:
+            yield from f
+        return
+
+    with open(file, 'rb', buffering=BUFFER_SIZE) as f:
+        f.seek(start)
+        pos = start
+        for line in f:
+            if pos >= end:
+                break
+            pos += len(line)
+            yield line.decode()
+
+
+def load_state(path, kind, options):
+    """Load state of the previous run: files and aggregate. State of
+    another script or with other options (--top, --sketch) can't be
+    continued and is dropped"""
+
+    empty = {'files': [], 'aggregate': None}
+
+    try:
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+            if (state.get('version'), state.get('kind'), state.get('options')) \
+                    != (STATE_VERSION, kind, options):
+                print(f"State {path} doesn't match current options, "
+                      "starting over")
+                return empty
+            # the aggregate follows the header: it is loaded only when
+            # it belongs to this script
+            state['aggregate'] = pickle.load(f)
+    except FileNotFoundError:
+        return empty
+
+    return state
+
+
+def save_state(path, kind, options, files, aggregate):
+    """Atomically write state for the next run"""
+
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump({'version': STATE_VERSION, 'kind': kind,
+                     'options': options, 'files': files}, f)
+        pickle.dump(aggregate, f)
+    os.replace(tmp, path)
+
+
+def read_head(file):
+    """First bytes of the file content"""
+
+    with open_log(file) as f:
+        return f.read(HEAD_SIZE)
+
+
+def last_line_end(file, size):
+    """Offset after the last newline: an incomplete line being written
+    now is left for the next run"""
+
+    with open(file, 'rb') as f:
+        pos = size
+        while pos > 0:
+            start = max(0, pos - BUFFER_SIZE)
+            f.seek(start)
+            found = f.read(pos - start).rfind(b'\n')
+            if found >= 0:
+                return start + found + 1
+            pos = start
+
+    return 0
+
+
+def plan_incremental(files, saved):
+    """Compare files with saved entries of the previous run and return
+    (file, start, end) ranges of unread content with new entries.
+
+    A file is recognized by a hash of its first bytes rather than by name,
+    so a rotated (renamed or compressed) log is continued from the saved
+    offset. A truncated or replaced file doesn't match and is read anew.
+    Offsets count bytes of decompressed content, compressed files are
+    expected to be complete (offset None after reading)."""
+
+    unclaimed = list(saved)
+    ranges = []
+    entries = []
+
+    for file in files:
+        st = os.stat(file)
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+        # unchanged since the last run
+        old = next((e for e in unclaimed if e['key'] == key), None)
+        if old:
+            unclaimed.remove(old)
+            entries.append(dict(old, path=str(file)))
+            continue
+
+        head = read_head(file)
+        matches = [e for e in unclaimed if 0 < e['head_len'] <= len(head) and
+                   e['head'] == hashlib.sha1(head[:e['head_len']]).hexdigest()]
+        # the same inode is the most likely match
+        matches.sort(key=lambda e: e['key'][:2] != key[:2])
+        old = matches[0] if matches else None
+        if old:
+            unclaimed.remove(old)
+
+        start = old['offset'] if old else 0
+        if compression(file):
+            end = offset = None
+        else:
+            end = offset = last_line_end(file, st.st_size)
+
+        if start is None:
+            pass
+        elif end is not None and end < start:
+            # truncated
+            ranges.append((file, 0, end))
+        elif end is None or end > start:
+            ranges.append((file, start, end))
+
+        entries.append({'path': str(file), 'key': key, 'offset': offset,
+                        'head': hashlib.sha1(head).hexdigest(),
+                        'head_len': len(head)})
+
+    return ranges, entries
+
+
+class SpaceSaving:
+    """Space-Saving summary of the most frequent keys in bounded memory.
+
+    Keeps at most 2 * capacity counters and prunes them to capacity in
+    batches. Counts are never underestimated and are overestimated by at
+    most floor, which is also an upper bound for any untracked key.
+    Summaries of different inputs can be merged."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.floor = 0
+
+    def add(self, key, n=1):
+        counts = self.counts
+        if key in counts:
+            counts[key] += n
+        else:
+            counts[key] = self.floor + n
+            if len(counts) > 2 * self.capacity:
+                self.prune()
+
+    def prune(self):
+        """Keep capacity largest counters, evicted ones raise the floor"""
+
+        ranked = sorted(self.counts.items(), key=itemgetter(1), reverse=True)
+        self.floor = max(self.floor, ranked[self.capacity][1])
+        self.counts = dict(ranked[:self.capacity])
+
+    def merge(self, other):
+        """Add summary of another input"""
+
+        counts = {key: n + other.counts.get(key, other.floor)
+                  for key, n in self.counts.items()}
+        for key, n in other.counts.items():
+            if key not in counts:
+                counts[key] = n + self.floor
+        self.counts = counts
+        self.floor += other.floor
+        if len(counts) > 2 * self.capacity:
+            self.prune()
+
+        return self
+
+    def most_common(self, n):
+        """n keys with the largest estimated counts, equal counts by key"""
+
+        return sorted(self.counts.items(), key=lambda kv: (-kv[1], kv[0]))[:n]
+
+
+class LogHistogram:
+    """HDR-like histogram of non-negative integers. Values below 256 are
+    counted exactly, larger ones in buckets 1/128 of a power of two wide,
+    so percentiles have under 0.4% relative error while the number of
+    buckets stays bounded. Histograms of different inputs can be merged."""
+
+    SUB_BITS = 7
+
+    def __init__(self):
+        self.counts = Counter()
+        self.total = 0
+
+    @classmethod
+    def index(cls, value):
+        shift = value.bit_length() - cls.SUB_BITS - 1
+        if shift <= 0:
+            return value
+        return (shift << cls.SUB_BITS) + (value >> shift)
+
+    @classmethod
+    def value(cls, index):
+        """Middle of the bucket"""
+
+        shift = (index >> cls.SUB_BITS) - 1
+        if shift <= 0:
+            return index
+        low = (index - (shift << cls.SUB_BITS)) << shift
+        return low + ((1 << shift) - 1) // 2
+
+    def add(self, value, n=1):
+        self.counts[self.index(value)] += n
+        self.total += n
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        self.total += other.total
+
+        return self
+
+    def percentile(self, p):
+        """Nearest-rank percentile"""
+
+        rank = max(1, ceil(self.total * p / 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return self.value(index)
+
+        return None
+
+    def percentiles(self):
+        return {f'p{p}': self.percentile(p) for p in PERCENTILES}
+
+
+def duration_percentiles(histograms):
+    """Percentiles of durations of all requests and per method"""
+
+    total = LogHistogram()
+    for hist in histograms.values():
+        total.merge(hist)
+
+    rep = {'ALL': total.percentiles()}
+    rep.update((method, histograms[method].percentiles())
+               for method in sorted(histograms))
+
+    return rep
+
+
+def bucket_report(buckets):
+    """Rows of the time-bucketed report ordered by window start. buckets
+    maps UTC epoch of a window start to (requests, 5xx errors, sum, count
+    and max of durations)"""
+
+    rows = []
+    for start in sorted(buckets):
+        requests, errors, total, count, longest = buckets[start]
+        rows.append({'start': strftime('%Y-%m-%dT%H:%M:%SZ', gmtime(start)),
+                     'requests': int(requests),
+                     'errors': int(errors),
+                     'error_rate': round(errors / requests, 4),
+                     'duration_avg': round(total / count, 1) if count else None,
+                     'duration_max': int(longest) if count else None})
+
+    return rows
+
+
+def parse_group_by(text):
+    """Fields of --group-by host,status"""
+
+    fields = tuple(field.strip() for field in text.split(','))
+    for field in fields:
+        if field not in GROUP_FIELDS:
+            raise ValueError(f"unknown group field: {field}")
+    if len(set(fields)) != len(fields):
+        raise ValueError(f"repeated group field: {text}")
+
+    return fields
+
+
+def parse_agg(text):
+    """(function, field) pairs of --agg count,sum:bytes,max:duration,
+    field is None for count"""
+
+    aggs = []
+    for spec in text.split(','):
+        op, _, field = spec.strip().partition(':')
+        if op not in AGG_OPS:
+            raise ValueError(f"unknown aggregate function: {op}")
+        if op == 'count':
+            if field:
+                raise ValueError(f"count takes no field: {spec}")
+            field = None
+        elif field not in AGG_FIELDS:
+            raise ValueError(f"unknown aggregate field: {spec}")
+        if (op, field) not in aggs:
+            aggs.append((op, field))
+
+    return tuple(aggs)
+
+
+def agg_name(op, field):
+    """Report column of an aggregate: count, sum:bytes"""
+
+    return op if field is None else f'{op}:{field}'
+
+
+def group_columns(aggs):
+    """Mergeable state columns of a group: the row count first, then
+    sums, counts of present values (n), minimums and maximums the
+    aggregates are computed from; avg is sum / n"""
+
+    columns = [('count', None)]
+    for op, field in aggs:
+        needed = [('sum', field), ('n', field)] if op == 'avg' else [(op, field)]
+        for column in needed:
+            if column not in columns:
+                columns.append(column)
+
+    return columns
+
+
+def group_report(groups, fields, aggs, top):
+    """top rows of the --group-by report. groups are (key, state) pairs,
+    state values are in group_columns() order, missing ones are None.
+    Rows go in descending order of the first aggregate, missing values
+    last, equal ones by key"""
+
+    columns = {column: i for i, column in enumerate(group_columns(aggs))}
+    rows = []
+    for key, state in groups:
+        row = dict(zip(fields, key))
+        for op, field in aggs:
+            if op == 'avg':
+                n = state[columns['n', field]]
+                value = round(state[columns['sum', field]] / n, 1) if n else None
+            else:
+                value = state[columns[op, field]]
+                value = None if value is None else int(value)
+            row[agg_name(op, field)] = value
+        rows.append(row)
+
+    first = agg_name(*aggs[0])
+
+    def order(row):
+        value = row[first]
+        return ((value is None, -(value or 0)) +
+                tuple((row[f] is not None, row[f]) for f in fields))
+
+    return heapq.nsmallest(top, rows, key=order)
+
+
+def line_time(line):
+    """Request time of a raw log line, None if there is none"""
+
+    start = line.find(b'[')
+    end = line.find(b']', start)
+    if start < 0 or end < 0:
+        return None
+
+    return log_time(line[start + 1:end].decode('ascii', 'replace'))
+
+
+def next_time(f, limit, tries=100):
+    """(offset, time) of the first line with a time starting at the
+    current position and before limit, (limit, None) if there is none"""
+
+    pos = f.tell()
+    for _ in range(tries):
+        if pos >= limit:
+            break
+        line = f.readline()
+        if not line:
+            break
+        epoch = line_time(line)
+        if epoch is not None:
+            return pos, epoch
+        pos += len(line)
+
+    return limit, None
+
+
+def first_line_at(f, size, epoch, lo=0, hi=None):
+    """Offset of the first line with time >= epoch in a time-ordered
+    file: bisect on byte offsets (seek, resync to the next line, read its
+    time) down to SEEK_BLOCK, then scan lines. lo must be a line start"""
+
+    hi = size if hi is None else hi
+
+    while hi - lo > SEEK_BLOCK:
+        mid = (lo + hi) // 2
+        f.seek(mid)
+        f.readline()
+        pos, t = next_time(f, hi)
+        if t is None or t >= epoch:
+            hi = mid
+        else:
+            lo = pos
+
+    f.seek(lo)
+    pos = lo
+    for line in f:
+        t = line_time(line)
+        if t is not None and t >= epoch:
+            return pos
+        pos += len(line)
+
+    return min(pos, size)
+
+
+def index_path(file):
+    """Sidecar index file, hidden so that it doesn't match log patterns"""
+
+    file = Path(file)
+
+    return file.with_name(f'.{file.name}.tidx')
+
+
+def load_index(file, f, size):
+    """Sparse (offset, time) points of the file every INDEX_STEP bytes,
+    from the sidecar index when it's still valid: the same inode and not
+    shrunk. New points of appended data are added and saved"""
+
+    path = index_path(file)
+    st = os.stat(file)
+    points = []
+    try:
+        with open(path) as idx:
+            saved = json.load(idx)
+        if (saved['ino'], saved['step']) == (st.st_ino, INDEX_STEP) \
+                and saved['size'] <= size:
+            points = saved['points']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    changed = False
+    offset = points[-1][0] // INDEX_STEP * INDEX_STEP + INDEX_STEP \
+        if points else 0
+    while offset < size:
+        f.seek(offset)
+        if offset:
+            f.readline()
+        pos, t = next_time(f, size)
+        if t is not None:
+            points.append((pos, t))
+        offset += INDEX_STEP
+        changed = True
+
+    if changed:
+        try:
+            with open(path, 'w') as idx:
+                json.dump({'ino': st.st_ino, 'size': size, 'step': INDEX_STEP,
+                           'points': points}, idx)
+        except OSError:
+            pass
+
+    return points
+
+
+def bracket(points, epoch, size):
+    """Byte range [lo, hi) surely containing the first line with time
+    >= epoch according to index points"""
+
+    lo, hi = 0, size
+    for pos, t in points:
+        if t < epoch:
+            lo = pos
+        else:
+            hi = pos
+            break
+
+    return lo, hi
+
+
+def window_range(file, since, until, index=False):
+    """Byte range of the plain file with requests from since to until,
+    widened by DISORDER seconds for nearly sorted logs"""
+
+    size = os.path.getsize(file)
+
+    with open(file, 'rb') as f:
+        points = load_index(file, f, size) if index else []
+        start, end = 0, size
+        if since is not None:
+            start = first_line_at(f, size, since - DISORDER,
+                                  *bracket(points, since - DISORDER, size))
+        if until is not None:
+            end = first_line_at(f, size, until + DISORDER,
+                                *bracket(points, until + DISORDER, size))
+
+    return start, max(start, end)
@@ -1,13 +1,24 @@
 # /usr/bin/env python3.9
 
+import hashlib
 import json
+import os
+import shutil
 from argparse import ArgumentParser
+from multiprocessing import Pool
 from pathlib import Path
 from time import time
 
 import numpy as np
 import pandas as pd
 
+from logparse_common import (BUCKETS, LogHistogram, SpaceSaving,
+                             agg_name, bucket_report, duration_percentiles,
+                             group_columns, group_report, jobs_count,
+                             load_state, make_tasks, minute_epoch, open_log,
+                             parse_agg, parse_group_by, parse_time,
+                             plan_incremental, save_state, split_tasks)
+
 '''
 Формат записи в файле лога (combined):
 %h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-Agent}i" %D
@@ -34,9 +45,55 @@ parser.add_argument('--to-file', nargs='?',
                     const='access_stats.json', default=None)
 parser.add_argument('--pattern', default='access*.log*')
 parser.add_argument('--top', type=int, default=3)
+parser.add_argument('--jobs', type=int, default=1)
+parser.add_argument('--state', default=None)
+parser.add_argument('--cache', nargs='?', const='.logparse_cache', default=None)
+parser.add_argument('--chunksize', type=int, default=None)
+parser.add_argument('--sketch', nargs='?', type=int, const=1000, default=None)
+parser.add_argument('--bucket', choices=BUCKETS, default=None)
+parser.add_argument('--since', type=parse_time, default=None)
+parser.add_argument('--until', type=parse_time, default=None)
+parser.add_argument('--index', action='store_true')
+parser.add_argument('--group-by', type=parse_group_by, default=None)
+parser.add_argument('--agg', type=parse_agg, default=None)
 args = parser.parse_args()
+if args.agg and not args.group_by:
+    parser.error('--agg requires --group-by')
+if args.group_by and (args.sketch or args.bucket):
+    parser.error("--group-by can't be combined with --sketch or --bucket")
 
 TOP = args.top
+JOBS = jobs_count(args.jobs)
+CACHE = args.cache
+CHUNKSIZE = args.chunksize
+SKETCH = args.sketch
+BUCKET = BUCKETS.get(args.bucket)
+SINCE = args.since
+UNTIL = args.until
+GROUP_BY = args.group_by
+AGG = args.agg or (('count', None),)
+
+BUCKET_AGG = {'requests': 'sum', 'errors': 'sum', 'duration_sum': 'sum',
+              'duration_count': 'sum', 'duration_max': 'max'}
+
+# columns of the report in output order
+REPORT_COLUMNS = ['host', 'timestamp', 'status', 'duration', 'method', 'url']
+# columns kept as categoricals after loading from the cache
+CATEGORICAL = {'host', 'method', 'status'}
+# columns of --group-by query: keys, aggregated fields, time of the window
+GROUP_COLUMNS = list(dict.fromkeys(
+    (GROUP_BY or ()) + tuple(field for _, field in AGG if field) +
+    (('timestamp',) if SINCE is not None or UNTIL is not None else ())))
+# columns loaded from the cache
+COLUMNS = GROUP_COLUMNS if GROUP_BY else REPORT_COLUMNS
+# columns read in --chunksize mode
+CHUNK_COLUMNS = ['host', 'timestamp', 'tz', 'request', 'status', 'duration'] + [
+    name for name in ('user', 'bytes', 'referer', 'ua') if name in COLUMNS]
+# pandas functions computing group_columns() of a chunk and merging them
+GROUP_FUNCS = {'count': 'size', 'sum': 'sum', 'n': 'count',
+               'min': 'min', 'max': 'max'}
+GROUP_MERGE = {'count': 'sum', 'sum': 'sum', 'n': 'sum',
+               'min': 'min', 'max': 'max'}
 
 
 def benchmark(func):
@@ -67,69 +124,584 @@ def get_files():
     return files
 
 
+def read_file(file, start=0, end=None):
+    """Read raw columns of one (possibly compressed) file from start
+    to end byte of its content, None if the range is empty"""
+
+    with open_log(file, start=start, end=end) as f:
+        if not f.peek(1):
+            return None
+        return read_log(f)
+
+
+def read_log(source, chunksize=None):
+    """Read raw columns of one stream or buffer. With chunksize return
+    an iterator over chunks of report columns with categorical hosts"""
+
+    if chunksize:
+        return pd.read_csv(source,
+                           delim_whitespace=True,
+                           quotechar='"',
+                           escapechar='\\',
+                           names=cols.keys(),
+                           usecols=CHUNK_COLUMNS,
+                           dtype={**cols, 'host': 'category'},
+                           na_values=["-", ""],
+                           chunksize=chunksize)
+
+    return pd.read_csv(source,
+                       delim_whitespace=True,
+                       quotechar='"',
+                       escapechar='\\',
+                       names=cols.keys(),
+                       dtype=cols,
+                       na_values=["-", ""])
+
+
+def clean_data(df):
+    """Build timestamp, method and url columns"""
+
+    df = df.drop(columns='l', errors='ignore')
+    df["timestamp"] = df["timestamp"].str.lstrip(
+        "[") + " " + df.pop("tz").str.rstrip("]")
+    df[['method', 'url']] = df.pop('request').str.split(' ', 1, expand=True)
+
+    return df
+
+
 def load_data(files):
     """Load data from given files"""
 
     try:
-        df = pd.concat((pd.read_csv(f,
-                                    delim_whitespace=True,
-                                    quotechar='"',
-                                    escapechar='\\',
-                                    names=cols.keys(),
-                                    dtype=cols,
-                                    na_values=["-", ""]) for f in files)).drop(columns='l')
+        if CACHE:
+            frames = [load_cached(f) for f in files]
+            if len(frames) == 1 and frames[0] is not None:
+                # concat would copy all columns of the only file
+                return frames[0]
+            return pd.concat(frames)
+        df = pd.concat(read_file(f) for f in files)
     except Exception as e:
         print(e)
         exit(1)
 
-    df["timestamp"] = df["timestamp"].str.lstrip(
-        "[") + " " + df.pop("tz").str.rstrip("]")
-    df[['method', 'url']] = df.pop('request').str.split(' ', 1, expand=True)
+    return clean_data(df)
 
-    return df
 
+def cache_path(file):
+    """Cache directory of the log file"""
 
-def prepare_report(df: pd.DataFrame):
-    '''Prepare report for console output'''
+    key = hashlib.sha1(str(Path(file).resolve()).encode()).hexdigest()
+
+    return Path(CACHE) / key
+
+
+def save_cache(file, df):
+    """Store cleaned data of the file as .npy columns: strings and
+    CATEGORICAL columns as category codes with categories, nullable
+    integers as values with NA mask"""
+
+    st = os.stat(file)
+    path = cache_path(file)
+    tmp = path.with_name(path.name + '.tmp')
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+
+    kinds = {}
+    for name, col in df.items():
+        if name in CATEGORICAL or col.dtype == object:
+            cat = col.astype('category').cat
+            np.save(tmp / f'{name}.codes.npy', cat.codes.to_numpy())
+            np.save(tmp / f'{name}.cats.npy',
+                    cat.categories.to_numpy(dtype=object), allow_pickle=True)
+            kinds[name] = 'category'
+        else:
+            np.save(tmp / f'{name}.values.npy',
+                    col.to_numpy(dtype='uint64', na_value=0))
+            np.save(tmp / f'{name}.mask.npy', col.isna().to_numpy())
+            kinds[name] = 'uint'
+
+    with open(tmp / 'meta.json', 'w') as f:
+        json.dump({'path': str(file), 'size': st.st_size,
+                   'mtime': st.st_mtime_ns, 'columns': kinds}, f)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+
+
+def load_cache(file, columns):
+    """Load given columns of the file from the cache,
+    None if there is no entry or the file has changed"""
+
+    path = cache_path(file)
+    try:
+        with open(path / 'meta.json') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    st = os.stat(file)
+    if (meta['size'], meta['mtime']) != (st.st_size, st.st_mtime_ns):
+        return None
+
+    # codes and integers are mapped read-only instead of being read
+    data = {}
+    for name in columns:
+        if meta['columns'][name] == 'category':
+            codes = np.load(path / f'{name}.codes.npy', mmap_mode='r')
+            cats = np.load(path / f'{name}.cats.npy', allow_pickle=True)
+            if name in CATEGORICAL:
+                data[name] = pd.Categorical.from_codes(codes, cats)
+            else:
+                # plain take is much cheaper than from_codes validation
+                # of large categories, code -1 picks the trailing NaN
+                data[name] = np.append(cats, np.nan)[codes]
+        else:
+            data[name] = pd.arrays.IntegerArray(
+                np.load(path / f'{name}.values.npy', mmap_mode='r'),
+                np.load(path / f'{name}.mask.npy', mmap_mode='r'))
+
+    # without copy=False the string columns are copied into one block
+    return pd.DataFrame(data, copy=False)
+
+
+def load_cached(file):
+    """Load report columns of the file from the cache,
+    parse the file and fill the cache on a miss"""
+
+    df = load_cache(file, COLUMNS)
+    if df is not None:
+        return df
+
+    df = read_file(file)
+    if df is None:
+        return None
+    df = clean_data(df)
+    save_cache(file, df)
+
+    return df[COLUMNS]
+
+
+def load_range(task):
+    """Load data from one (file, start, end) byte range
+    or from the whole file if end is None"""
+
+    file, start, end = task
+    if end is None and start == 0 and CACHE:
+        return load_cached(file)
+
+    df = read_file(file, start, end)
+
+    return None if df is None else clean_data(df)
+
+
+def value_counts(col):
+    """Value counts without unused categories of categorical columns"""
+
+    counts = col.value_counts(dropna=True, ascending=False)
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        counts = counts[counts > 0]
+        counts.index = counts.index.astype(object)
+
+    return counts
+
+
+def prepare_partial(df: pd.DataFrame):
+    """Full counters and longest requests of one chunk of data,
+    in --sketch mode bounded summaries of hosts, urls and durations"""
+
+    if SINCE is not None or UNTIL is not None:
+        df = df[in_window(df)]
+
+    if GROUP_BY:
+        return {'group': group_stats(df)}
+
+    part = {"method": value_counts(df['method']),
+            "host": value_counts(df['host']),
+            "request": longest_requests(df)
+            }
+
+    if SKETCH:
+        part['host'] = summarize(part['host'])
+        urls = value_counts(df['url'])
+        # request path without protocol, as in logparse_re
+        urls.index = urls.index.str.rsplit(' ', n=1).str[0]
+        part['url'] = summarize(urls)
+        part['duration'] = {
+            method: histogram(durations) for method, durations in
+            df.groupby('method', observed=True)['duration']}
+
+    if BUCKET:
+        part['bucket'] = bucket_stats(df)
+
+    return part
+
+
+def group_key(col):
+    """Column as a --group-by key. pandas drops missing values of
+    categorical keys: they are grouped as objects, integer ones (status
+    loaded from the cache) as nullable integers like in parsed data,
+    objects with NaN would give float keys"""
+
+    if not isinstance(col.dtype, pd.CategoricalDtype):
+        return col
+    if pd.api.types.is_integer_dtype(col.cat.categories):
+        return col.astype(pd.UInt64Dtype())
+
+    return col.astype(object)
+
+
+def group_stats(df):
+    """--group-by state of one chunk: group_columns() of every group
+    computed in a single groupby, indexed by key fields"""
+
+    keys = [group_key(df[field]) for field in GROUP_BY]
+    stats = df.groupby(keys, dropna=False, sort=False).agg(**{
+        agg_name(op, field): (field or GROUP_BY[0], GROUP_FUNCS[op])
+        for op, field in group_columns(AGG)})
+
+    if 'url' in GROUP_BY:
+        # request path without protocol, as in logparse_re
+        index = stats.index.to_frame(index=False)
+        index['url'] = index['url'].str.rsplit(' ', n=1).str[0]
+        stats.index = pd.MultiIndex.from_frame(index)
+        stats = merge_groups([stats])
+
+    return stats
+
+
+def merge_groups(stats):
+    """Merge --group-by states of chunks"""
+
+    return pd.concat(stats).groupby(
+        level=list(range(len(GROUP_BY))), dropna=False, sort=False).agg(
+        {agg_name(op, field): GROUP_MERGE[op] for op, field in group_columns(AGG)})
+
+
+def group_rows(stats):
+    """(key, state) pairs of the --group-by state, NA values as None"""
+
+    keys = stats.index.to_frame(index=False).astype(object)
+    for key, state in zip(keys.itertuples(index=False, name=None),
+                          stats.astype(object).itertuples(index=False, name=None)):
+        yield (tuple(None if pd.isna(v) else v for v in key),
+               [None if pd.isna(v) else v for v in state])
+
+
+def epochs(df):
+    """UTC epoch seconds of request times, NaN if malformed. Like in
+    logparse_re each distinct minute and zone is converted only once:
+    to_datetime with %z parses every element in Python"""
+
+    ts = df['timestamp'].astype(object).str
+    codes, keys = pd.factorize(ts.slice(0, 17) + ts.slice(20))
+    minutes = [minute_epoch(f'{key[:17]}:00{key[17:]}') for key in keys]
+    # code -1 of a missing time picks the trailing NaN
+    minutes = np.array([np.nan if m is None else m for m in minutes] + [np.nan],
+                       dtype='float64')
+    seconds = pd.to_numeric(ts.slice(18, 20), errors='coerce')
+
+    return minutes[codes] + seconds.to_numpy(dtype='float64')
+
+
+def in_window(df):
+    """Mask of requests from --since to --until"""
+
+    epoch = epochs(df)
+    mask = ~np.isnan(epoch)
+    if SINCE is not None:
+        mask &= epoch >= SINCE
+    if UNTIL is not None:
+        mask &= epoch < UNTIL
+
+    return mask
+
+
+def bucket_stats(df):
+    """Requests, 5xx errors and durations per --bucket window
+    indexed by UTC epoch of the window start"""
+
+    epoch = epochs(df)
+    # requests with malformed time are dropped before the conversion
+    valid = ~np.isnan(epoch)
+    ts = pd.to_datetime(epoch[valid], unit='s', utc=True)
+    status = df['status'].astype('float64').to_numpy()[valid]
+    duration = df['duration'].astype('float64').to_numpy()[valid]
+
+    frame = pd.DataFrame({'requests': 1,
+                          'errors': (status >= 500).astype('int64'),
+                          'duration_sum': duration,
+                          'duration_count': ~np.isnan(duration),
+                          'duration_max': duration}, index=ts)
+    stats = frame.resample(f'{BUCKET}s').agg(BUCKET_AGG)
+    stats = stats[stats['requests'] > 0]
+    stats.index = stats.index.asi8 // 10 ** 9
+
+    return stats
+
+
+def summarize(counts):
+    """Space-Saving summary of value counts"""
+
+    summary = SpaceSaving(SKETCH)
+    for key, n in counts.items():
+        summary.add(key, int(n))
+
+    return summary
+
+
+def histogram(durations):
+    """Histogram of durations"""
+
+    hist = LogHistogram()
+    for value, n in durations.value_counts().items():
+        hist.add(int(value), int(n))
+
+    return hist
+
+
+def longest_requests(df):
+    """TOP rows with the longest duration, equal durations in input order
+    and missing ones last, so that merged chunks give the same result.
+    Selects rows by positions without sorting the whole frame"""
+
+    duration = df['duration'].to_numpy(dtype='int64', na_value=-1)
+    if TOP <= 0:
+        pos = np.arange(0)
+    elif len(duration) > TOP:
+        kth = np.partition(duration, len(duration) - TOP)[len(duration) - TOP]
+        pos = np.flatnonzero(duration > kth)
+        pos = np.sort(np.concatenate(
+            [pos, np.flatnonzero(duration == kth)[:TOP - len(pos)]]))
+    else:
+        pos = np.arange(len(duration))
+    pos = pos[np.argsort(-duration[pos], kind='stable')]
+
+    # column by column: iloc on the frame would first consolidate it
+    return pd.DataFrame({name: df[name].take(pos) for name in REPORT_COLUMNS})
+
+
+def merge_partials(parts):
+    """Sum counters and join longest requests of chunks"""
+
+    parts = list(parts)
+
+    if GROUP_BY:
+        return {'group': merge_groups(p['group'] for p in parts)}
+
+    if SKETCH:
+        host, url, duration = parts[0]['host'], parts[0]['url'], parts[0]['duration']
+        for p in parts[1:]:
+            host.merge(p['host'])
+            url.merge(p['url'])
+            for method, hist in p['duration'].items():
+                duration.setdefault(method, LogHistogram()).merge(hist)
+    else:
+        host = pd.concat(p['host'] for p in parts).groupby(level=0).sum()
+
+    part = {"method": pd.concat(p['method'] for p in parts).groupby(level=0).sum(),
+            "host": host,
+            "request": pd.concat(p['request'] for p in parts).sort_values(
+                by=['duration'], ascending=False, kind='stable').head(TOP)
+            }
+    if SKETCH:
+        part['url'] = url
+        part['duration'] = duration
+    if BUCKET:
+        part['bucket'] = pd.concat(p['bucket'] for p in parts).groupby(
+            level=0).agg(BUCKET_AGG)
+
+    return part
+
+
+def ranked(counts, top=0):
+    """Counts in descending order, equal counts by name. With top
+    only counts up to the top-th largest are sorted, not all names"""
+
+    if 0 < top < len(counts):
+        values = counts.to_numpy()
+        kth = np.partition(values, len(values) - top)[len(values) - top]
+        counts = counts[values >= kth]
+
+    return counts.sort_index(kind='stable').sort_values(
+        ascending=False, kind='stable')
+
+
+def finish_report(part):
+    """Build report from counters and longest requests"""
+
+    if GROUP_BY:
+        return {'group': group_report(group_rows(part['group']),
+                                      GROUP_BY, AGG, TOP)}
 
     rep = {"method": None,
            "host": None,
            "request": None
            }
 
-    reqs = df['method'].value_counts(dropna=True, ascending=False).to_dict()
+    reqs = ranked(part['method']).to_dict()
     rep['method'] = reqs
     rep['method']['TOTAL'] = sum(reqs.values())
 
-    rep['host'] = df['host'].value_counts(
-        dropna=True, ascending=False).head(TOP).to_dict()
+    if SKETCH:
+        rep['host'] = dict(part['host'].most_common(TOP))
+        rep['url'] = dict(part['url'].most_common(TOP))
+        rep['duration'] = duration_percentiles(part['duration'])
+    else:
+        rep['host'] = ranked(part['host'], TOP).head(TOP).to_dict()
+
+    if BUCKET:
+        rep['bucket'] = bucket_report(
+            {start: tuple(row) for start, row in zip(
+                part['bucket'].index, part['bucket'].itertuples(index=False))})
 
-    long_reqs = df.sort_values(by=['duration'], ascending=False).drop(
-        columns=['user', 'bytes', 'referer', 'ua']).head(TOP)
+    long_reqs = part['request'].sort_values(
+        by=['duration'], ascending=False, kind='stable').head(TOP)
     rep['request'] = long_reqs.astype(object).replace(
         np.nan, 'Null').to_dict(orient='records')
 
     return rep
 
 
+def prepare_report(df: pd.DataFrame):
+    '''Prepare report for console output'''
+
+    return finish_report(prepare_partial(df))
+
+
+def partial_chunks(file, start=0, end=None):
+    """Partial report of the file range read in chunks of --chunksize
+    rows: only running counters and top requests are kept in memory"""
+
+    part = None
+
+    with open_log(file, start=start, end=end) as f:
+        if not f.peek(1):
+            return None
+        for chunk in read_log(f, CHUNKSIZE):
+            chunk_part = prepare_partial(clean_data(chunk))
+            part = chunk_part if part is None else merge_partials(
+                [part, chunk_part])
+
+    return part
+
+
+def partial_range(task):
+    """Worker: partial report of one byte range, None if it's empty"""
+
+    if CHUNKSIZE and not CACHE:
+        return partial_chunks(*task)
+
+    df = load_range(task)
+
+    return None if df is None else prepare_partial(df)
+
+
+def parse_tasks(tasks):
+    """Partial reports of (file, start, end) tasks,
+    in worker processes if --jobs is given"""
+
+    if JOBS > 1 and len(tasks) > 1:
+        with Pool(min(JOBS, len(tasks))) as pool:
+            parts = pool.map(partial_range, tasks)
+    else:
+        parts = [partial_range(task) for task in tasks]
+
+    parts = [part for part in parts if part is not None]
+
+    # nothing to read, e.g. --since/--until window is outside of the logs
+    return parts or [prepare_partial(pd.DataFrame(
+        {name: pd.Series(dtype=object) for name in COLUMNS}))]
+
+
+def prepare_report_parallel(files):
+    """Build partial reports of files and their byte ranges (of
+    --since/--until window) in worker processes if --jobs is given
+    and merge them"""
+
+    try:
+        if CACHE:
+            # a file per task, cached files aren't split
+            tasks = [(file, 0, None) for file in files]
+        else:
+            tasks = make_tasks(files, JOBS, SINCE, UNTIL, args.index)
+        part = merge_partials(parse_tasks(tasks))
+    except Exception as e:
+        print(e)
+        exit(1)
+
+    return finish_report(part)
+
+
+def prepare_report_incremental(files, path):
+    """Build partial report of content added since the run saved
+    in the state file and merge it with the saved one"""
+
+    try:
+        options = {'top': TOP, 'sketch': SKETCH, 'bucket': BUCKET,
+                   'since': SINCE, 'until': UNTIL,
+                   'group_by': GROUP_BY, 'agg': GROUP_BY and AGG}
+        state = load_state(path, 'logparse_pd', options)
+        ranges, entries = plan_incremental(files, state['files'])
+        parts = parse_tasks(split_tasks(ranges, JOBS))
+        if state['aggregate'] is not None:
+            parts.insert(0, state['aggregate'])
+        part = merge_partials(parts)
+        save_state(path, 'logparse_pd', options, entries, part)
+    except Exception as e:
+        print(e)
+        exit(1)
+
+    return finish_report(part)
+
+
 def out_to_console(rep):
     """Output report to console"""
 
     print(f"Access log(s) analysis summary:\n")
+    if 'group' in rep:
+        out_groups(rep['group'])
+        return
     print("HTTP methods statistics:\n")
     for k, v in rep['method'].items():
         print(f'\t{k}: {v}')
     print()
-    print(f"Top {TOP} hosts by requests:\n")
+    approx = ' (approximate)' if SKETCH else ''
+    print(f"Top {TOP} hosts by requests{approx}:\n")
     for k, v in rep['host'].items():
         print(f'\t{k}: {v}')
     print()
+    if 'url' in rep:
+        print(f"Top {TOP} urls by requests{approx}:\n")
+        for k, v in rep['url'].items():
+            print(f'\t{k}: {v}')
+        print()
+    if 'duration' in rep:
+        print("Request duration percentiles, ms:\n")
+        for k, v in rep['duration'].items():
+            print(f'\t{k}: ' + ' '.join(f'{p}={d}' for p, d in v.items()))
+        print()
+    if 'bucket' in rep:
+        print(f"Requests per {args.bucket}:\n")
+        for r in rep['bucket']:
+            print(f"\t{r['start']} requests={r['requests']} "
+                  f"errors={r['errors']} ({r['error_rate']:.2%}) "
+                  f"avg={r['duration_avg']} ms max={r['duration_max']} ms")
+        print()
     print(f"Top {TOP} longest requests:\n")
     for r in rep['request']:
         print(
             f"\t{r['host']} {r['timestamp']} {r['method']} {r['url']} {r['duration']} ms \n")
 
 
+def out_groups(rows):
+    """Output --group-by report to console"""
+
+    print(f"Top {TOP} groups by {agg_name(*AGG[0])}:\n")
+    for r in rows:
+        print('\t' + ' '.join(f'{k}={v}' for k, v in r.items()))
+    print()
+
+
 def out_to_file(rep, file):
     """Output json report to file"""
 
@@ -144,7 +716,12 @@ def out_to_file(rep, file):
 @benchmark
 def main():
 
-    rep = prepare_report(load_data(get_files()))
+    if args.state:
+        rep = prepare_report_incremental(get_files(), args.state)
+    elif JOBS > 1 or CHUNKSIZE or SINCE is not None or UNTIL is not None:
+        rep = prepare_report_parallel(get_files())
+    else:
+        rep = prepare_report(load_data(get_files()))
 
     out_to_console(rep)
 
@@ -1,12 +1,28 @@
 # /usr/bin/env python3
 
+import heapq
 import itertools
 import json
+import mmap
+import os
 import re
+import sys
 from argparse import ArgumentParser
+from collections import Counter
+from multiprocessing import Pool
+from operator import itemgetter
 from pathlib import Path
 from time import time
 
+from logparse_common import (BUCKETS, LogHistogram, SpaceSaving,
+                             agg_name, bucket_report, compression,
+                             duration_percentiles,
+                             gen_range_lines, group_columns, group_report,
+                             in_window, jobs_count, load_state, log_time,
+                             make_tasks, minute_epoch, open_log, parse_agg,
+                             parse_group_by, parse_time, plan_incremental,
+                             save_state, split_tasks)
+
 '''
 Формат записи в файле лога (combined):
 %h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-Agent}i" %D
@@ -23,6 +39,19 @@ from time import time
 '''
 # ip: (\d{1,3}\.){3}\d{1,3}), но в этом поле встречаются и доменные имена
 PATTERN = r'(?P<host>\S+)\s+(?P<l>\S+)\s+(?P<user>\S+)\s+\[(?P<time>.+)\]\s+\"(?P<method>GET|POST|HEAD|OPTIONS|PUT|TRACE|TRACK|DELETE|FLURP)\s+(?P<url>\S+)\s+(\S+)\"\s+(?P<status>\d{3})\s+(?P<bytes>\S+)\s+\"(?P<referer>.*)\"\s+\"(?P<ua>.*)\"\s+(?P<duration>\S+)'
+LINE_RE = re.compile(PATTERN)
+# PATTERN over a whole buffer of lines for the mmap engine: \s must not
+# cross line ends, the rest of the line is consumed
+BYTES_PATTERN = (rb'^[ \r]*' + PATTERN.replace(r'\s+', r'[^\S\n]+').encode() +
+                 rb'[^\n]*')
+BYTES_RE = re.compile(BYTES_PATTERN, re.MULTILINE)
+# compressed logs are scanned by the mmap engine in slices of this size
+SCAN_SLICE = 16 * 1024 * 1024
+METHODS = frozenset(('GET', 'POST', 'HEAD', 'OPTIONS',
+                     'PUT', 'TRACE', 'TRACK', 'DELETE', 'FLURP'))
+# fields of split_line() in the order of the log line
+FIELDS = ('host', 'l', 'user', 'time', 'method', 'url', 'status', 'bytes',
+          'referer', 'ua', 'duration')
 
 parser = ArgumentParser()
 group = parser.add_mutually_exclusive_group()
@@ -32,9 +61,63 @@ parser.add_argument('--to-file', nargs='?',
                     const='access_stats.json', default=None)
 parser.add_argument('--pattern', default='access*.log*')
 parser.add_argument('--top', type=int, default=3)
+parser.add_argument('--engine', choices=('re', 'split', 'mmap'), default='split')
+parser.add_argument('--jobs', type=int, default=1)
+parser.add_argument('--state', default=None)
+parser.add_argument('--sketch', nargs='?', type=int, const=1000, default=None)
+parser.add_argument('--bucket', choices=BUCKETS, default=None)
+parser.add_argument('--since', type=parse_time, default=None)
+parser.add_argument('--until', type=parse_time, default=None)
+parser.add_argument('--index', action='store_true')
+parser.add_argument('--group-by', type=parse_group_by, default=None)
+parser.add_argument('--agg', type=parse_agg, default=None)
 args = parser.parse_args()
+if args.agg and not args.group_by:
+    parser.error('--agg requires --group-by')
+if args.group_by and (args.sketch or args.bucket):
+    parser.error("--group-by can't be combined with --sketch or --bucket")
 
 TOP = args.top
+ENGINE = args.engine
+JOBS = jobs_count(args.jobs)
+SKETCH = args.sketch
+BUCKET = BUCKETS.get(args.bucket)
+SINCE = args.since
+UNTIL = args.until
+GROUP_BY = args.group_by
+AGG = args.agg or (('count', None),)
+
+
+def query_fields():
+    """Fields of log lines the report is built from, the default report
+    also shows all fields of the longest requests"""
+
+    if GROUP_BY:
+        fields = set(GROUP_BY) | {field for _, field in AGG if field}
+    else:
+        fields = {'host', 'method', 'duration'}
+        if SKETCH:
+            fields.add('url')
+        if BUCKET:
+            fields |= {'time', 'status'}
+    if SINCE is not None or UNTIL is not None:
+        fields.add('time')
+
+    return fields
+
+
+def prune_captures(pattern, fields):
+    """The pattern with only the groups of the given fields capturing,
+    the other groups are made non-capturing: captures are costly"""
+
+    return re.sub(r'\(\?P<(\w+)>|\((?!\?)',
+                  lambda m: m[0] if m[1] in fields else '(?:', pattern)
+
+
+# BYTES_RE capturing only the fields of the query
+SCAN_FIELDS = frozenset(query_fields())
+SCAN_RE = re.compile(
+    prune_captures(BYTES_PATTERN.decode(), SCAN_FIELDS).encode(), re.MULTILINE)
 
 
 def benchmark(func):
@@ -68,84 +151,562 @@ def get_files():
 def gen_data(files):
     """Load data from given files"""
 
+    parse = line_parser()
+
     for file in files:
         try:
-            with open(file, 'r') as f:
+            if ENGINE == 'mmap':
+                yield from map(BytesRow, scan_file(file))
+                continue
+            with open_log(file, 'r') as f:
                 for line in f:
                     line = line.strip(' \n\r')
                     if line:
-                        yield parse_line(line)
+                        yield parse(line)
         except Exception as e:
             print(e)
             exit(1)
 
 
 def parse_line(line):
-    raw = re.match(PATTERN, line)
+    raw = LINE_RE.match(line)
     if raw:
         return raw.groupdict()
     else:
         print('NO_MATCH ', line)
 
 
+def scan_file(file, start=0, end=None):
+    """Matches of SCAN_RE over the bytes of the file from start to end:
+    plain files are mapped into memory and scanned in place, compressed
+    ones are decompressed and scanned in slices of whole lines"""
+
+    if compression(file) is None:
+        with open(file, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                end = size if end is None else end
+                if end and buf[end - 1] != ord('\n'):
+                    # finish the last line as gen_range_lines() does
+                    end = buf.find(b'\n', end) + 1 or size
+                yield from scan(buf, start, end)
+        return
+
+    with open_log(file, start=start) as f:
+        tail = b''
+        while True:
+            block = f.read(SCAN_SLICE)
+            if not block:
+                yield from scan(tail, 0, len(tail))
+                return
+            block = tail + block
+            cut = block.rfind(b'\n') + 1
+            yield from scan(block, 0, cut)
+            tail = block[cut:]
+
+
+def scan(buf, pos, endpos):
+    """Matches of SCAN_RE from pos to endpos of the buffer,
+    lines between matches are reported as not matching"""
+
+    for match in SCAN_RE.finditer(buf, pos, endpos):
+        if match.start() > pos:
+            no_match(buf[pos:match.start()])
+        pos = match.end() + 1
+        yield match
+
+    if pos < endpos:
+        no_match(buf[pos:endpos])
+
+
+def no_match(lines):
+    for line in lines.split(b'\n'):
+        line = line.strip(b' \n\r')
+        if line:
+            print('NO_MATCH ', line.decode(errors='replace'))
+
+
+# decoded host and method names of the mmap engine
+names = {}
+
+
+class BytesRow:
+    """Row of the mmap engine: fields are taken from the match and decoded
+    on access. Fields not in SCAN_FIELDS, e.g. url, time and status of the
+    longest requests, are taken from the line matched again with all
+    groups. Hosts and methods are decoded once and shared by all rows"""
+
+    __slots__ = ('match', 'full')
+
+    def __init__(self, match):
+        self.match = match
+        self.full = None
+
+    def __getitem__(self, field):
+        if field in SCAN_FIELDS:
+            value = self.match[field]
+        else:
+            if self.full is None:
+                self.full = BYTES_RE.match(self.match.string, self.match.start())
+            value = self.full[field]
+        if field == 'host' or field == 'method':
+            name = names.get(value)
+            if name is None:
+                name = names[value] = sys.intern(value.decode(errors='replace'))
+            return name
+        return value.decode(errors='replace')
+
+
+def line_parser():
+    """Parser of log lines of the --engine, with --group-by
+    it extracts only the fields of the query"""
+
+    if GROUP_BY:
+        return project_line(query_fields())
+
+    return tokenize_line if ENGINE == 'split' else parse_line
+
+
+def split_line(line):
+    """Fields of a combined log line split on quotes and whitespace
+    in FIELDS order, None if the line is of unusual shape"""
+
+    # host l user [time] |method url proto| status bytes |referer| |ua| duration
+    parts = line.split('"')
+
+    if len(parts) != 7 or line[0].isspace():
+        return None
+
+    prefix, request, result, referer, gap, ua, suffix = parts
+
+    try:
+        host, l, user, time = prefix.split(None, 3)
+        time = time.rstrip()
+        method, url, proto = request.split()
+        status, size = result.split()
+        duration = suffix.split(None, 1)[0]
+    except (ValueError, IndexError):
+        return None
+
+    if (time[0] != '[' or time[-1] != ']' or len(time) < 3 or
+            not prefix[-1].isspace() or
+            method not in METHODS or
+            request[0].isspace() or request[-1].isspace() or
+            not result[0].isspace() or not result[-1].isspace() or
+            len(status) != 3 or not status.isdecimal() or
+            not gap or not gap.isspace() or
+            not suffix[0].isspace()):
+        return None
+
+    return (host, l, user, time[1:-1], method, url, status, size,
+            referer, ua, duration)
+
+
+def tokenize_line(line):
+    """Split combined log line on quotes and whitespace, lines
+    of unusual shape are passed to the regular expression"""
+
+    fields = split_line(line)
+    if fields is None:
+        return parse_line(line)
+
+    host, l, user, time, method, url, status, size, referer, ua, duration = fields
+
+    return {'host': host, 'l': l, 'user': user, 'time': time,
+            'method': method, 'url': url, 'status': status, 'bytes': size,
+            'referer': referer, 'ua': ua, 'duration': duration}
+
+
+def project_line(fields):
+    """Parser of the given fields only: rows hold just these fields.
+    The re engine matches LINE_RE capturing only them; split has to
+    split the whole line for the shape checks of tokenize_line(),
+    so only the rows are smaller. Results don't depend on --engine"""
+
+    positions = [(field, FIELDS.index(field)) for field in fields]
+    regex = re.compile(prune_captures(PATTERN, fields))
+
+    def match_line(line):
+        raw = regex.match(line)
+        if raw:
+            return raw.groupdict()
+        else:
+            print('NO_MATCH ', line)
+
+    if ENGINE == 're':
+        return match_line
+
+    def tokenize(line):
+        values = split_line(line)
+        if values is None:
+            return match_line(line)
+
+        return {field: values[i] for field, i in positions}
+
+    return tokenize
+
+
+class GroupAggregator:
+    """--group-by state: a dict from the tuple of key field values to
+    the list of group_columns() of the group. '-' and empty values are
+    missing (None) as in logparse_pd, status is a number"""
+
+    def __init__(self, fields=None, aggs=None, top=None):
+        self.fields = GROUP_BY if fields is None else fields
+        self.aggs = AGG if aggs is None else aggs
+        self.top = TOP if top is None else top
+        self.columns = group_columns(self.aggs)
+        self.groups = {}
+        self.init_cache()
+
+    def init_cache(self):
+        # states by raw field values, saves normalizing keys of every row
+        self.raw = {}
+        self.key = itemgetter(*self.fields)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['raw'], state['key']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.init_cache()
+
+    @staticmethod
+    def key_value(field, value):
+        if value == '-' or not value:
+            return None
+        return int(value) if field == 'status' else value
+
+    def state(self, raw):
+        """State of the group of raw key field values"""
+
+        raw_key = raw if len(self.fields) > 1 else (raw,)
+        key = tuple(self.key_value(field, value)
+                    for field, value in zip(self.fields, raw_key))
+        state = self.groups.get(key)
+        if state is None:
+            state = self.groups[key] = [0] + [
+                0 if op in ('sum', 'n') else None for op, _ in self.columns[1:]]
+        self.raw[raw] = state
+
+        return state
+
+    def add(self, row):
+        raw = self.key(row)
+        state = self.raw.get(raw)
+        if state is None:
+            state = self.state(raw)
+        state[0] += 1
+
+        for i, (op, field) in enumerate(self.columns[1:], 1):
+            value = row[field]
+            if not value.isdecimal():
+                continue
+            if op == 'n':
+                state[i] += 1
+                continue
+            value = int(value)
+            if op == 'sum':
+                state[i] += value
+            elif state[i] is None or (value < state[i] if op == 'min'
+                                      else value > state[i]):
+                state[i] = value
+
+    def merge(self, other):
+        """Add state of the aggregator built over the following input"""
+
+        for key, other_state in other.groups.items():
+            state = self.groups.get(key)
+            if state is None:
+                self.groups[key] = list(other_state)
+                continue
+            for i, (op, _) in enumerate(self.columns):
+                value = other_state[i]
+                if op in ('count', 'sum', 'n'):
+                    state[i] += value
+                elif value is not None and (
+                        state[i] is None or
+                        (value < state[i] if op == 'min' else value > state[i])):
+                    state[i] = value
+
+        return self
+
+    def report(self):
+        return {'group': group_report(self.groups.items(), self.fields,
+                                      self.aggs, self.top)}
+
+
+def new_aggregator():
+    """Aggregator of the report: --group-by or the default one"""
+
+    return GroupAggregator() if GROUP_BY else Aggregator()
+
+
+class Aggregator:
+    """Streaming report state: method and host counters and a min-heap
+    of the TOP longest requests. Aggregators built over separate files
+    or chunks are merged in input order"""
+
+    def __init__(self, top=None, sketch=None, bucket=None):
+        self.top = TOP if top is None else top
+        self.sketch = SKETCH if sketch is None else sketch
+        self.bucket = BUCKET if bucket is None else bucket
+        # window start: [requests, 5xx errors, duration sum, count, max]
+        self.buckets = {}
+        self.methods = Counter()
+        if self.sketch:
+            # bounded memory: approximate top hosts and urls,
+            # duration histograms per method
+            self.hosts = SpaceSaving(self.sketch)
+            self.urls = SpaceSaving(self.sketch)
+            self.durations = {}
+        else:
+            self.hosts = Counter()
+        # (duration, seq, request): on equal durations later rows win
+        self.longest = []
+        self.seq = 0
+
+    def add(self, row):
+        self.methods[row['method']] += 1
+
+        duration = int(row['duration'])
+        self.seq += 1
+
+        if self.sketch:
+            self.hosts.add(row['host'])
+            self.urls.add(row['url'])
+            hist = self.durations.get(row['method'])
+            if hist is None:
+                hist = self.durations[row['method']] = LogHistogram()
+            hist.add(duration)
+        else:
+            self.hosts[row['host']] += 1
+
+        if self.bucket:
+            epoch = minute_epoch(row['time'])
+            if epoch is not None:
+                start = epoch - epoch % self.bucket
+                stats = self.buckets.get(start)
+                if stats is None:
+                    stats = self.buckets[start] = [0, 0, 0, 0, 0]
+                stats[0] += 1
+                if row['status'][0] == '5':
+                    stats[1] += 1
+                stats[2] += duration
+                stats[3] += 1
+                if duration > stats[4]:
+                    stats[4] = duration
+
+        if len(self.longest) < self.top:
+            heapq.heappush(self.longest, (duration, self.seq, self.request(row)))
+        elif self.longest and (duration, self.seq) > self.longest[0][:2]:
+            heapq.heapreplace(self.longest, (duration, self.seq, self.request(row)))
+
+    @staticmethod
+    def request(row):
+        """Fields of the request shown in the report"""
+
+        return {'host': row['host'], 'time': row['time'],
+                'method': row['method'], 'url': row['url'],
+                'status': row['status'], 'duration': row['duration']}
+
+    def merge(self, other):
+        """Add state of the aggregator built over the following input"""
+
+        self.methods.update(other.methods)
+        if self.sketch:
+            self.hosts.merge(other.hosts)
+            self.urls.merge(other.urls)
+            for method, hist in other.durations.items():
+                self.durations.setdefault(method, LogHistogram()).merge(hist)
+        else:
+            self.hosts.update(other.hosts)
+
+        for start, other_stats in other.buckets.items():
+            stats = self.buckets.get(start)
+            if stats is None:
+                self.buckets[start] = list(other_stats)
+            else:
+                for i in range(4):
+                    stats[i] += other_stats[i]
+                stats[4] = max(stats[4], other_stats[4])
+
+        for duration, seq, request in other.longest:
+            item = (duration, seq + self.seq, request)
+            if len(self.longest) < self.top:
+                heapq.heappush(self.longest, item)
+            elif item[:2] > self.longest[0][:2]:
+                heapq.heapreplace(self.longest, item)
+        self.seq += other.seq
+
+        return self
+
+    def report(self):
+        """Build report, counters with equal values go in reverse
+        order of appearance"""
+
+        methods = sorted(zip(self.methods.values(), itertools.count(),
+                             self.methods), reverse=True)
+
+        rep = {"method": {method: n for n, _, method in methods},
+               "host": None,
+               "request": [request for *_, request in
+                           sorted(self.longest, key=lambda x: x[:2], reverse=True)]
+               }
+        rep['method'].update({'TOTAL': sum(self.methods.values())})
+
+        if self.sketch:
+            rep['host'] = dict(self.hosts.most_common(self.top))
+            rep['url'] = dict(self.urls.most_common(self.top))
+            rep['duration'] = duration_percentiles(self.durations)
+        else:
+            hosts = heapq.nlargest(self.top, zip(self.hosts.values(),
+                                                 itertools.count(), self.hosts))
+            rep['host'] = {host: n for n, _, host in hosts}
+
+        if self.bucket:
+            rep['bucket'] = bucket_report(self.buckets)
+
+        return rep
+
+
+def aggregate(data):
+    """Feed parsed rows to a new aggregator"""
+
+    agg = new_aggregator()
+
+    if SINCE is not None or UNTIL is not None:
+        data = (row for row in data
+                if row and in_window(log_time(row['time']), SINCE, UNTIL))
+
+    for row in data:
+        if row:
+            agg.add(row)
+
+    return agg
+
+
+def aggregate_range(task):
+    """Worker: aggregate lines of one (file, start, end) range"""
+
+    if ENGINE == 'mmap':
+        return aggregate(map(BytesRow, scan_file(*task)))
+
+    parse = line_parser()
+
+    return aggregate(parse(line) for line in
+                     (line.strip(' \n\r') for line in gen_range_lines(*task))
+                     if line)
+
+
 def prepare_report(data):
     '''Prepare report for console output'''
 
-    rep = {"method": {},
-           "host": {},
-           "request": []
-           }
+    return aggregate(data).report()
 
-    for row in data:
 
-        if not row or not len(row):
-            continue
+def merge_tasks(agg, tasks):
+    """Aggregate (file, start, end) tasks, in worker processes if --jobs
+    is given, and merge results into agg in input order"""
+
+    if JOBS > 1 and len(tasks) > 1:
+        with Pool(min(JOBS, len(tasks))) as pool:
+            for part in pool.imap(aggregate_range, tasks):
+                agg.merge(part)
+    else:
+        for task in tasks:
+            agg.merge(aggregate_range(task))
+
+    return agg
+
 
-        for key in ('l', 'user', 'bytes', 'referer', 'ua'):
-            row.pop(key)
+def prepare_report_parallel(files):
+    """Aggregate files and their byte ranges (of --since/--until window)
+    in worker processes if --jobs is given, merge partial results
+    in input order"""
+
+    try:
+        agg = merge_tasks(new_aggregator(), make_tasks(files, JOBS, SINCE, UNTIL,
+                                                   args.index))
+    except Exception as e:
+        print(e)
+        exit(1)
 
-        for k, v in row.items():
+    return agg.report()
 
-            if k in ('host', 'method'):
-                if not rep[k].get(v):
-                    rep[k].update({v: 0})
-                rep[k].update({v: rep[k][v] + 1})
 
-            if k == 'duration':
-                rep['request'].append(row)
-                rep['request'] = sorted(
-                    rep['request'], key=lambda x: int(x['duration']))
-                if len(rep['request']) > TOP:
-                    rep['request'].pop(0)
+def prepare_report_incremental(files, path):
+    """Aggregate only content added since the run saved in the state file
+    and merge it into the saved aggregate"""
 
-    rep['method'] = dict(
-        reversed(sorted(rep['method'].items(), key=lambda x: x[1])))
-    rep['method'].update({'TOTAL': sum(rep['method'].values())})
-    rep['host'] = dict(itertools.islice(
-        reversed(sorted(rep['host'].items(), key=lambda x: x[1])), TOP))
-    rep['request'].reverse()
+    try:
+        options = {'top': TOP, 'sketch': SKETCH, 'bucket': BUCKET,
+                   'since': SINCE, 'until': UNTIL,
+                   'group_by': GROUP_BY, 'agg': GROUP_BY and AGG}
+        state = load_state(path, 'logparse_re', options)
+        ranges, entries = plan_incremental(files, state['files'])
+        agg = merge_tasks(state['aggregate'] or new_aggregator(),
+                          split_tasks(ranges, JOBS))
+        save_state(path, 'logparse_re', options, entries, agg)
+    except Exception as e:
+        print(e)
+        exit(1)
 
-    return rep
+    return agg.report()
 
 
 def out_to_console(rep):
     """Output report to console"""
 
     print(f"Access log(s) analysis summary:\n")
+    if 'group' in rep:
+        out_groups(rep['group'])
+        return
     print("HTTP methods statistics:\n")
     for k, v in rep['method'].items():
         print(f'\t{k}: {v}')
     print()
-    print(f"Top {TOP} hosts by requests:\n")
+    approx = ' (approximate)' if SKETCH else ''
+    print(f"Top {TOP} hosts by requests{approx}:\n")
     for k, v in rep['host'].items():
         print(f'\t{k}: {v}')
     print()
+    if 'url' in rep:
+        print(f"Top {TOP} urls by requests{approx}:\n")
+        for k, v in rep['url'].items():
+            print(f'\t{k}: {v}')
+        print()
+    if 'duration' in rep:
+        print("Request duration percentiles, ms:\n")
+        for k, v in rep['duration'].items():
+            print(f'\t{k}: ' + ' '.join(f'{p}={d}' for p, d in v.items()))
+        print()
+    if 'bucket' in rep:
+        print(f"Requests per {args.bucket}:\n")
+        for r in rep['bucket']:
+            print(f"\t{r['start']} requests={r['requests']} "
+                  f"errors={r['errors']} ({r['error_rate']:.2%}) "
+                  f"avg={r['duration_avg']} ms max={r['duration_max']} ms")
+        print()
     print(f"Top {TOP} longest requests:\n")
     for r in rep['request']:
         print(
             f"\t{r['host']} {r['time']} {r['method']} {r['url']} {r['duration']} ms \n")
 
 
+def out_groups(rows):
+    """Output --group-by report to console"""
+
+    print(f"Top {TOP} groups by {agg_name(*AGG[0])}:\n")
+    for r in rows:
+        print('\t' + ' '.join(f'{k}={v}' for k, v in r.items()))
+    print()
+
+
 def out_to_file(rep, file):
     """Output json report to file"""
 
@@ -160,7 +721,12 @@ def out_to_file(rep, file):
 @benchmark
 def main():
 
-    rep = prepare_report(gen_data(get_files()))
+    if args.state:
+        rep = prepare_report_incremental(get_files(), args.state)
+    elif JOBS > 1 or SINCE is not None or UNTIL is not None:
+        rep = prepare_report_parallel(get_files())
+    else:
+        rep = prepare_report(gen_data(get_files()))
 
     out_to_console(rep)
 